@@ -5,28 +5,99 @@ move game logic to another file. Ideally the API will be simple, concerned
 primarily with communication to/from the API's users."""
 
 
+import datetime
+import json
+import logging
+import time
+
 import endpoints
 from protorpc import remote, messages
 from google.appengine.api import memcache
 from google.appengine.ext import ndb
 from google.appengine.api import taskqueue
+from google.appengine.api import datastore_errors
+from google.appengine.runtime import apiproxy_errors
 
-from models import User, Game, Score, GameHistory
+from models import User, Game, Score, ActiveGames, MoveReceipt, Tournament, \
+    BOARD_FORMATS, COMPUTER_NAME
 from models import StringMessage, NewGameForm, GameForm, GameForms,\
-    MakeMoveForm, ScoreForms
-from utils import get_by_urlsafe
+    GameSummaryForm, GameCountsForm, GameUpdateForm, HintForm, MakeMoveForm, \
+    ScoreForms, NewGamesForm, GameKeysForm, NewTournamentForm, \
+    TournamentForm, MakeMovesForm, MovesResultForm
+from utils import get_by_urlsafe, key_from_urlsafe, fetch_page, page_size
+import archive
+import cache
+import counters
+import hints
+from instrumentation import instrumented
+import leaderboard
+import movelog
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GAME_REQUEST = endpoints.ResourceContainer(
         urlsafe_game_key=messages.StringField(1),)
+GET_GAME_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    board_format=messages.StringField(2))
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1),)
+MAKE_MOVES_REQUEST = endpoints.ResourceContainer(
+    MakeMovesForm,
+    urlsafe_game_key=messages.StringField(1),)
+WAIT_FOR_MOVE_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    since_version=messages.IntegerField(2, default=0),
+    wait_seconds=messages.IntegerField(3, default=0))
 CREATE_USER_REQUEST = endpoints.ResourceContainer(
     user_name=messages.StringField(1), email=messages.StringField(2))
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1))
-
-MEMCACHE_NUM_ACTIVE_GAMES = 'NUM_ACTIVE_GAMES'
+PAGE_REQUEST = endpoints.ResourceContainer(
+    limit=messages.IntegerField(1), page_token=messages.StringField(2))
+NEW_GAMES_REQUEST = endpoints.ResourceContainer(NewGamesForm)
+NEW_TOURNAMENT_REQUEST = endpoints.ResourceContainer(NewTournamentForm)
+TOURNAMENT_REQUEST = endpoints.ResourceContainer(
+    urlsafe_tournament_key=messages.StringField(1),)
+USER_GAMES_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    limit=messages.IntegerField(2),
+    page_token=messages.StringField(3),
+    summary=messages.BooleanField(4))
+GAME_HISTORY_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    limit=messages.IntegerField(2),
+    page_token=messages.StringField(3),
+    since_move=messages.IntegerField(4),
+    board_format=messages.StringField(5))
+
+ACTIVE_GAMES_COUNTER = 'active_games'
+
+MEMCACHE_GAME_VERSION = 'game-version-{}'
+MAX_WAIT_SECONDS = 20
+WAIT_POLL_SECONDS = 0.5
+PUBLISH_VERSION_RETRIES = 5
+
+# A version missed after a commit, because the request died first, is only
+# trusted for this long before readers go back to the datastore
+GAME_VERSION_SECONDS = 60
+
+MEMCACHE_MOVE_RECEIPT = 'move-receipt-{}'
+MOVE_RECEIPT_SECONDS = 600
+MAX_REQUEST_ID_LENGTH = 100
+
+MAX_BATCH_GAMES = 500
+
+# Gives create_games_batch and create_tournament time to write their games
+# before the task that makes sure they are in ActiveGames runs
+ADD_ACTIVE_GAMES_DELAY_SECONDS = 60
+MAX_TOURNAMENT_PLAYERS = 32
+
+# Enough moves to fill the largest board
+MAX_BATCH_MOVES = 25
+
+# freak_factor is stored as a signed 32 bit number in the archive
+MIN_FREAK_FACTOR = -2 ** 31
+MAX_FREAK_FACTOR = 2 ** 31 - 1
 
 
 @endpoints.api(name='tic_tac_toe', version='v1')
@@ -37,15 +108,25 @@ class TicTacToeApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
+        if not User.normalize(request.user_name):
+            raise endpoints.BadRequestException('User name is required')
+
+        # Until then an old User differing only in case can't be found
+        if not User.migration_done():
+            raise endpoints.ForbiddenException(
+                'Sign ups are closed until existing users are migrated')
+        if User.normalize(request.user_name) == \
+                User.normalize(COMPUTER_NAME) or \
+                User.get_by_name(request.user_name):
             raise endpoints.ConflictException(
                     'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
-        score = Score(parent=user.key, wins=0, losses=0, ties=0)
-        score.put()
+        self._create_user(request.user_name, request.email)
+
+        # The new user's Score belongs in the rankings
+        leaderboard.invalidate()
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
@@ -54,220 +135,866 @@ class TicTacToeApi(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented
     def new_game(self, request):
-        """Creates new game"""
-        player_one = User.query(User.name == request.player_one_name).get()
-        player_two = User.query(User.name == request.player_two_name).get()
+        """Creates new game. With vs_computer the computer is player two
+        and player_two_name isn't needed."""
+        self._check_not_computer(request.player_one_name)
+        if not request.vs_computer:
+            self._check_not_computer(request.player_two_name)
+        player_one = User.get_by_name(request.player_one_name)
         if not player_one:
             raise endpoints.NotFoundException(
                 'Player one "' + request.player_one_name + '" does not exist!'
             )
 
+        if request.vs_computer:
+            player_two = self._computer_user()
+        elif not request.player_two_name:
+            raise endpoints.BadRequestException(
+                'player_two_name is required unless vs_computer is set')
+        else:
+            player_two = User.get_by_name(request.player_two_name)
+
         if not player_two:
             raise endpoints.NotFoundException(
                 'Player two "' + request.player_two_name + '" does not exist!'
             )
 
-        game = Game.new_game(player_one.key,
-                             player_two.key,
-                             request.freak_factor)
+        self._check_freak_factor(request.freak_factor)
+        game = self._create_game(player_one.key,
+                                 player_two.key,
+                                 request.freak_factor)
+        return game.to_form(game.last_message())
 
-        # Increment active count of games
-        taskqueue.add(url='/tasks/increment_active_games')
-
-        message = "Game created successfully"
-        game_history = GameHistory(parent=game.key)
-        game_history.history.append(game)
-        game_history.messages.append(message)
-        game_history.put()
-
-        return game.to_form(message)
-
-    @endpoints.method(request_message=GAME_REQUEST,
+    @endpoints.method(request_message=NEW_GAMES_REQUEST,
+                      response_message=GameKeysForm,
+                      path='games/batch',
+                      name='create_games_batch',
+                      http_method='POST')
+    @instrumented
+    def create_games_batch(self, request):
+        """Creates many games at once. Returns their keys in the order they
+        were asked for."""
+        if not request.games:
+            raise endpoints.BadRequestException('No games to create')
+        if len(request.games) > MAX_BATCH_GAMES:
+            raise endpoints.BadRequestException(
+                'At most {} games can be created at once'.format(
+                    MAX_BATCH_GAMES))
+        for form in request.games:
+            if not form.vs_computer and not form.player_two_name:
+                raise endpoints.BadRequestException(
+                    'player_two_name is required unless vs_computer is set')
+            self._check_not_computer(form.player_one_name)
+            if not form.vs_computer:
+                self._check_not_computer(form.player_two_name)
+            self._check_freak_factor(form.freak_factor)
+
+        names = [form.player_one_name for form in request.games] + \
+            [form.player_two_name for form in request.games
+             if not form.vs_computer]
+        users = self._users_by_name(names)
+        computer = self._computer_user() \
+            if any(form.vs_computer for form in request.games) else None
+
+        games = self._create_games([
+            (users[User.normalize(form.player_one_name)].key,
+             computer.key if form.vs_computer
+             else users[User.normalize(form.player_two_name)].key,
+             form.freak_factor)
+            for form in request.games])
+        return GameKeysForm(urlsafe_keys=[game.key.urlsafe()
+                                          for game in games])
+
+    @endpoints.method(request_message=NEW_TOURNAMENT_REQUEST,
+                      response_message=TournamentForm,
+                      path='tournament',
+                      name='create_tournament',
+                      http_method='POST')
+    @instrumented
+    def create_tournament(self, request):
+        """Creates a round-robin tournament with a game between every pair
+        of players"""
+        normalized = [User.normalize(name) for name in request.player_names]
+        if len(set(normalized)) != len(normalized) or len(normalized) < 2:
+            raise endpoints.BadRequestException(
+                'A tournament needs at least two different players')
+        if len(normalized) > MAX_TOURNAMENT_PLAYERS:
+            raise endpoints.BadRequestException(
+                'A tournament can have at most {} players'.format(
+                    MAX_TOURNAMENT_PLAYERS))
+        self._check_freak_factor(request.freak_factor)
+        self._check_not_computer(*request.player_names)
+
+        users = self._users_by_name(request.player_names)
+        players = [users[name].key for name in normalized]
+        pairs = [(players[first], players[second], request.freak_factor)
+                 for first in range(len(players))
+                 for second in range(first + 1, len(players))]
+
+        tournament = Tournament(name=request.name,
+                                freak_factor=request.freak_factor,
+                                players=players)
+        games = self._create_games(pairs, tournament)
+        return tournament.to_form(games)
+
+    @endpoints.method(request_message=TOURNAMENT_REQUEST,
+                      response_message=TournamentForm,
+                      path='tournament/{urlsafe_tournament_key}',
+                      name='get_tournament',
+                      http_method='GET')
+    @instrumented
+    def get_tournament(self, request):
+        """Returns a tournament's games and standings"""
+        tournament = get_by_urlsafe(request.urlsafe_tournament_key,
+                                    Tournament)
+        if not tournament:
+            raise endpoints.NotFoundException('Tournament not found!')
+        return tournament.to_form(archive.get_multi(tournament.games))
+
+    @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented
     def get_game(self, request):
-        """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-            return game.to_form()
-        else:
+        """Return the current game state. board_format picks how the board
+        is written: 'json' (the default), 'flat' or 'packed'. If the
+        If-None-Match header has the game's current ETag only not_modified,
+        the version and the ETag are returned."""
+        board_format = self._board_format(request.board_format)
+
+        def game_etag(version):
+            return '"g{}-{}"'.format(version, board_format)
+
+        version = self._unchanged_version(request.urlsafe_game_key,
+                                          game_etag)
+        if version is None:
+            game = archive.get_by_urlsafe(request.urlsafe_game_key)
+            if not game:
+                raise endpoints.NotFoundException('Game not found!')
+
+            etag = game_etag(game.version)
+            if not self._etag_matches(etag):
+                form = game.to_form(board_format=board_format)
+                form.etag = etag
+                return form
+            version = game.version
+
+        return GameForm(urlsafe_key=request.urlsafe_game_key,
+                        version=version, etag=game_etag(version),
+                        not_modified=True)
+
+    @endpoints.method(request_message=WAIT_FOR_MOVE_REQUEST,
+                      response_message=GameUpdateForm,
+                      path='game/{urlsafe_game_key}/wait',
+                      name='wait_for_move',
+                      http_method='GET')
+    @instrumented
+    def wait_for_move(self, request):
+        """Returns the game once its version is past since_version. Waits up
+        to wait_seconds for that to happen, checking only memcache, and then
+        returns modified=False without touching the datastore."""
+        key = key_from_urlsafe(request.urlsafe_game_key)
+        version_key = MEMCACHE_GAME_VERSION.format(key.urlsafe())
+        deadline = time.time() + \
+            min(max(request.wait_seconds or 0, 0), MAX_WAIT_SECONDS)
+
+        version = memcache.get(version_key)
+        while version is not None and version <= request.since_version and \
+                time.time() < deadline:
+            time.sleep(WAIT_POLL_SECONDS)
+            version = memcache.get(version_key)
+
+        if version is not None and version <= request.since_version:
+            return GameUpdateForm(modified=False, version=version)
+
+        # memcache doesn't know the version or it has moved on
+        game = archive.get_by_urlsafe(request.urlsafe_game_key)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if version is None:
+            memcache.add(version_key, game.version,
+                         time=GAME_VERSION_SECONDS)
+
+        if game.version <= request.since_version:
+            return GameUpdateForm(modified=False, version=game.version)
+        return GameUpdateForm(modified=True, version=game.version,
+                              game=game.to_form())
+
+    @endpoints.method(request_message=GAME_REQUEST,
+                      response_message=HintForm,
+                      path='game/{urlsafe_game_key}/hint',
+                      name='get_hint',
+                      http_method='GET')
+    @instrumented
+    def get_hint(self, request):
+        """Suggests a move for the player whose turn it is"""
+        game = cache.get_by_urlsafe(request.urlsafe_game_key, Game)
+        if not game:
             raise endpoints.NotFoundException('Game not found!')
+        if game.game_over:
+            raise endpoints.BadRequestException('Game already over!')
+
+        row, col, outlook = hints.hint(game.get_bitboard(), game.whos_turn)
+        return HintForm(move_row=row, move_col=col, outlook=outlook)
 
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @instrumented
     def make_move(self, request):
-        """Makes a move. Returns a game state with message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game.game_over:
-            return game.to_form('Game already over!')
-
-        if (game.whos_turn == 1 and
-                game.player_one.get().name != request.player_name) or \
-           (game.whos_turn == 2 and
-                game.player_two.get().name != request.player_name):
-            return game.to_form('Please wait your turn!')
-
-        try:
-            game.move(request.move_row, request.move_col)
-            game.put()
-
-        except ValueError as error:
-            return game.to_form(error.message)
-
-        if game.game_over is True:
-            taskqueue.add(url='/tasks/decrement_active_games')
-            message = "Thank you for playing. " + \
-                      request.player_name + " has won the game."
-        else:
-            message = "Move accepted. Please wait for your next turn."
-
-        game_history = GameHistory.query(ancestor=game.key).get()
-        game_history.history.append(game)
-        game_history.messages.append(message)
-        game_history.put()
+        """Makes a move. Returns a game state with message. A request_id
+        makes retries safe: a repeated request_id gets the first result
+        back instead of making the move again."""
+        receipt_key = None
+        if request.request_id:
+            if len(request.request_id) > MAX_REQUEST_ID_LENGTH:
+                raise endpoints.BadRequestException(
+                    'request_id can be at most {} characters'.format(
+                        MAX_REQUEST_ID_LENGTH))
+            receipt_key = MoveReceipt.key_for(
+                key_from_urlsafe(request.urlsafe_game_key),
+                request.player_name, request.request_id)
+
+            message = memcache.get(
+                MEMCACHE_MOVE_RECEIPT.format(receipt_key.urlsafe()))
+            if message is not None:
+                game = cache.get_by_urlsafe(request.urlsafe_game_key, Game)
+                if game:
+                    return game.to_form(message)
+
+        moves = [(request.player_name, request.move_row, request.move_col)]
+        game, message, made = self._apply_moves(
+            request.urlsafe_game_key, moves, receipt_key,
+            self._plan_computer_replies(request.urlsafe_game_key, moves))
+
+        if made:
+            self._moves_committed(game)
+            if receipt_key:
+                memcache.set(
+                    MEMCACHE_MOVE_RECEIPT.format(receipt_key.urlsafe()),
+                    message, time=MOVE_RECEIPT_SECONDS)
 
         return game.to_form(message)
 
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=MAKE_MOVES_REQUEST,
+                      response_message=MovesResultForm,
+                      path='game/{urlsafe_game_key}/moves',
+                      name='make_moves',
+                      http_method='POST')
+    @instrumented
+    def make_moves(self, request):
+        """Makes a sequence of moves, for bots and importing replays. They
+        are checked in order and applying stops at the first one that can't
+        be made or when the game ends. The moves made are committed
+        together. Returns how many were made and the game state."""
+        if not request.moves:
+            raise endpoints.BadRequestException('No moves to make')
+        if len(request.moves) > MAX_BATCH_MOVES:
+            raise endpoints.BadRequestException(
+                'At most {} moves can be made at once'.format(
+                    MAX_BATCH_MOVES))
+
+        moves = [(move.player_name, move.move_row, move.move_col)
+                 for move in request.moves]
+        game, message, made = self._apply_moves(
+            request.urlsafe_game_key, moves, None,
+            self._plan_computer_replies(request.urlsafe_game_key, moves))
+
+        if made:
+            self._moves_committed(game)
+
+        return MovesResultForm(moves_made=made, game=game.to_form(message))
+
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @instrumented
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        """Return a page of scores"""
+        scores, next_token = fetch_page(Score.query(), request.limit,
+                                        request.page_token)
+        return ScoreForms(items=Score.to_forms(scores),
+                          next_page_token=next_token)
 
     @endpoints.method(request_message=USER_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_score',
                       http_method='GET')
+    @instrumented
     def get_user_score(self, request):
         """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
         scores = Score.query(ancestor=user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        return ScoreForms(items=Score.to_forms(scores))
 
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='user/rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented
     def get_user_rankings(self, request):
-        scores = Score.query().order(-Score.wins, -Score.ties, +Score.losses)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        """Returns a page of user scores ranked from highest to lowest.
+        If the If-None-Match header has the page's current ETag only
+        not_modified and the ETag are returned."""
+        generation = leaderboard.generation()
+        etag = leaderboard.etag(request.limit, request.page_token, generation)
+        if self._etag_matches(etag):
+            return ScoreForms(etag=etag, not_modified=True)
 
-    @endpoints.method(request_message=USER_REQUEST,
+        try:
+            forms = leaderboard.page(request.limit, request.page_token,
+                                     generation)
+        except ValueError as error:
+            raise endpoints.BadRequestException(error.message)
+        forms.etag = etag
+        return forms
+
+    @endpoints.method(request_message=USER_GAMES_REQUEST,
                       response_message=GameForms,
                       path='user/games',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented
     def get_user_games(self, request):
-        """Returns all of the users active games"""
-        user = User.query(User.name == request.user_name).get()
+        """Returns a page of the users active games. With summary set only
+        GameSummaryForms are returned and no boards are loaded."""
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                 'User name is required')
+        if request.summary:
+            return self._user_game_summaries(user.key, request.limit,
+                                             request.page_token)
+
+        active = ActiveGames.key_for(user.key).get()
+        if active is not None:
+            try:
+                start = int(request.page_token or 0)
+            except ValueError:
+                start = -1
+            if start < 0:
+                raise endpoints.BadRequestException('Invalid page token')
+            end = start + page_size(request.limit)
+
+            # A game can end just as /tasks/add_active_games adds it
+            games = [game for game in ndb.get_multi(active.games[start:end])
+                     if game is not None and not game.game_over]
+            next_token = str(end) if end < len(active.games) else None
+            return GameForms(items=Game.to_forms(games),
+                             next_page_token=next_token)
+
+        # Users without an ActiveGames fall back to querying.
+        # OR queries only support cursors when ordered by key
         games = Game.query(
             ndb.AND(ndb.OR(Game.player_one == user.key,
                            Game.player_two == user.key),
-                    Game.game_over == False))
-        return GameForms(items=[game.to_form() for game in games])
+                    Game.game_over == False)).order(Game.key)
+        games, next_token = fetch_page(games, request.limit,
+                                       request.page_token)
+        return GameForms(items=Game.to_forms(games),
+                         next_page_token=next_token)
+
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=GameCountsForm,
+                      path='user/games/counts',
+                      name='get_user_game_counts',
+                      http_method='GET')
+    @instrumented
+    def get_user_game_counts(self, request):
+        """Returns how many active games the user has and in how many it is
+        their turn"""
+        user = User.get_by_name(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+
+        active = ActiveGames.key_for(user.key).get()
+        if active is None:
+            active = self._build_active_games(user.key)
+
+        # Whose turn it is changes with every move, so it is read from the
+        # games rather than kept in ActiveGames
+        games = [game for game in ndb.get_multi(active.games)
+                 if game is not None and not game.game_over]
+        return GameCountsForm(
+            active_games=len(games),
+            my_turn=len([game for game in games
+                         if game.player_to_move() == user.key]))
 
     @endpoints.method(response_message=StringMessage,
                       path='games/active_games',
                       name='get_num_active_games',
                       http_method='GET')
+    @instrumented
     def get_num_active_games(self, request):
-        """Get the cached average moves remaining"""
-        cached_num_games = memcache.get(MEMCACHE_NUM_ACTIVE_GAMES)
-
-        if isinstance(cached_num_games, int) is False:
-            cached_num_games = Game.query(Game.game_over == False).count()
-            memcache.set(MEMCACHE_NUM_ACTIVE_GAMES, cached_num_games)
-            print cached_num_games
-            print "had to query for cached games"
-        else:
-            print "already had cached_games"
-
+        """Get the number of active games"""
+        num_games = counters.get_count(ACTIVE_GAMES_COUNTER)
         return StringMessage(message="Found " +
-                                     str(cached_num_games) + " active games.")
+                                     str(num_games) + " active games.")
 
     @endpoints.method(request_message=GAME_REQUEST,
                       response_message=StringMessage,
                       path='games/{urlsafe_game_key}/cancel',
                       name='cancel_game',
                       http_method='PUT')
+    @instrumented
     def cancel_game(self, request):
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = self._cancel(request.urlsafe_game_key)
+        cache.invalidate(game.key)
+        self._publish_version(game)
+        return StringMessage(message=game.last_message())
+
+    @endpoints.method(request_message=GAME_HISTORY_REQUEST,
+                      response_message=GameForms,
+                      path='games/{urlsafe_game_key}/history',
+                      name='game_history',
+                      http_method='GET')
+    @instrumented
+    def game_history(self, request):
+        """Returns a page of the states the game has been through. The page
+        token is the index of the first state in the page. Without a page
+        token the page starts after since_move states, so a client only gets
+        what it hasn't seen. board_format works as for get_game, and 'delta'
+        only gives the full board for the first state in the page. The rest
+        carry just the move in move_row and move_col. If the If-None-Match
+        header has the page's current ETag only not_modified and the ETag
+        are returned."""
+        board_format = self._board_format(request.board_format, True)
+
+        try:
+            start = int(request.page_token or request.since_move or 0)
+        except ValueError:
+            start = -1
+        if start < 0:
+            raise endpoints.BadRequestException('Invalid page token')
+        end = start + page_size(request.limit)
+
+        def history_etag(version):
+            return '"h{}-{}-{}-{}"'.format(version, start, end, board_format)
+
+        version = self._unchanged_version(request.urlsafe_game_key,
+                                          history_etag)
+        if version is not None:
+            return GameForms(etag=history_etag(version), not_modified=True)
+
+        game = archive.get_by_urlsafe(request.urlsafe_game_key)
         if not game:
             raise endpoints.NotFoundException('Game not found!')
 
+        etag = history_etag(game.version)
+        if self._etag_matches(etag):
+            return GameForms(etag=etag, not_modified=True)
+
+        # Rebuild every intermediate state by replaying the move log
+        game.load_move_log()
+        states, names = game.replay()
+        next_token = str(end) if end < len(states) else None
+
+        items = []
+        for index, (state, message, move) in enumerate(states[start:end]):
+            if board_format == 'delta' and index == 0:
+                form = state.to_form(message, names, 'flat')
+            else:
+                form = state.to_form(message, names, board_format)
+            if move is not None:
+                form.move_row, form.move_col = move
+            items.append(form)
+
+        return GameForms(items=items, next_page_token=next_token, etag=etag)
+
+    def _etag_matches(self, etag):
+        """Check if the request's If-None-Match header has the etag"""
+        if_none_match = self.request_state.headers.get('If-None-Match')
+        return bool(if_none_match) and \
+            etag in [tag.strip() for tag in if_none_match.split(',')]
+
+    def _unchanged_version(self, urlsafe_game_key, make_etag):
+        """Checks the ETag for a game's version as published to memcache,
+        so an unchanged game is answered without reading it. Returns the
+        version if the client has it, otherwise None."""
+        key = key_from_urlsafe(urlsafe_game_key)
+        version = memcache.get(MEMCACHE_GAME_VERSION.format(key.urlsafe()))
+        if version is not None and self._etag_matches(make_etag(version)):
+            return version
+        return None
+
+    @staticmethod
+    def _check_not_computer(*names):
+        """Raises a BadRequestException if any of the player names is the
+        computer's. It only plays as player two in games made with
+        vs_computer, because it never makes the first move."""
+        if User.normalize(COMPUTER_NAME) in [User.normalize(name)
+                                             for name in names]:
+            raise endpoints.BadRequestException(
+                'Use vs_computer to play against the computer')
+
+    @staticmethod
+    def _check_freak_factor(freak_factor):
+        """Raises a BadRequestException if freak_factor is out of range"""
+        if not MIN_FREAK_FACTOR <= freak_factor <= MAX_FREAK_FACTOR:
+            raise endpoints.BadRequestException(
+                'freak_factor must be between {} and {}'.format(
+                    MIN_FREAK_FACTOR, MAX_FREAK_FACTOR))
+
+    @staticmethod
+    def _board_format(board_format, allow_delta=False):
+        """Checks a requested board_format and returns it, or 'json' if
+        none was given"""
+        board_format = board_format or 'json'
+        if board_format not in BOARD_FORMATS or \
+                (board_format == 'delta' and not allow_delta):
+            raise endpoints.BadRequestException(
+                'Unknown board_format ' + board_format)
+        return board_format
+
+    def _moves_committed(self, game):
+        """Updates the caches after moves have been committed"""
+        cache.invalidate(game.key)
+        self._publish_version(game)
+
+        # Scores changed so cached rankings pages are stale
         if game.game_over is True:
-            raise endpoints.ForbiddenException(
-                'You can not cancel this game as it is already over!')
+            leaderboard.invalidate()
 
-        # Save the game.
-        # A game with no winner and with game_over=True is a cancelled game.
-        game.game_over = True
-        game.put()
+    @staticmethod
+    def _publish_version(game):
+        """Lets wait_for_move see the game's new version. Requests can
+        finish out of order, so the published version only moves
+        forward."""
+        version_key = MEMCACHE_GAME_VERSION.format(game.key.urlsafe())
+        client = memcache.Client()
+        for _ in range(PUBLISH_VERSION_RETRIES):
+            current = client.gets(version_key)
+            if current is None:
+                if client.add(version_key, game.version,
+                              time=GAME_VERSION_SECONDS):
+                    return
+            elif current >= game.version:
+                return
+            elif client.cas(version_key, game.version,
+                            time=GAME_VERSION_SECONDS):
+                return
+
+        # Losing the race every time means memcache is struggling, so drop
+        # the version rather than leave an old one behind
+        client.delete(version_key)
 
-        # Decrement active games
-        taskqueue.add(url='/tasks/decrement_active_games')
+    @staticmethod
+    def _user_game_summaries(user_key, limit, page_token):
+        """Pages through the games where the user is player 1 and then the
+        games where they are player 2 using projection queries. Page tokens
+        are '<player>:<cursor>'."""
+        start_player, _, cursor = (page_token or '1:').partition(':')
+        if start_player not in ('1', '2'):
+            raise endpoints.BadRequestException('Invalid page token')
+        limit = page_size(limit)
+
+        games = []
+        next_token = None
+        for player in range(int(start_player), 3):
+            if len(games) == limit:
+                next_token = '{}:'.format(player)
+                break
+
+            page, next_cursor = fetch_page(
+                Game.summary_query(user_key, player),
+                limit - len(games),
+                cursor if player == int(start_player) else None)
+            games.extend((game, player) for game in page)
+            if next_cursor:
+                next_token = '{}:{}'.format(player, next_cursor)
+                break
+
+        # Each projection only loads the opponent, the user is the other
+        players = [(game.key,
+                    user_key if player == 1 else game.player_one,
+                    user_key if player == 2 else game.player_two,
+                    game.whos_turn)
+                   for game, player in games]
+        names = User.names_for([key for _, one, two, _ in players
+                                for key in (one, two)])
+        return GameForms(summaries=[
+            GameSummaryForm(urlsafe_key=key.urlsafe(),
+                            player_one_name=names[one],
+                            player_two_name=names[two],
+                            whos_turn=whos_turn)
+            for key, one, two, whos_turn in players],
+            next_page_token=next_token)
 
-        message = "The game was cancelled successfuly."
+    @staticmethod
+    @ndb.transactional
+    def _create_user(name, email):
+        """Creates a User and their Score. Claiming the name-based key in a
+        transaction means two concurrent signups can't both succeed."""
+        key = User.key_for(name)
+        if key.get():
+            raise endpoints.ConflictException(
+                    'A User with that name already exists!')
+        user = User(key=key, name=name, email=email)
+        score = Score(key=Score.key_for(key), wins=0, losses=0, ties=0,
+                      player_name=name)
+        active = ActiveGames(key=ActiveGames.key_for(key))
+        ndb.put_multi([user, score, active])
+        return user
 
-        # Update game history
-        game_history = GameHistory.query(ancestor=game.key).get()
-        game_history.history.append(game)
-        game_history.messages.append(message)
-        game_history.put()
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _create_game(player_one, player_two, freak_factor):
+        """Creates a game and adds it to both players' ActiveGames"""
+        game = Game.new_game(player_one, player_two, freak_factor)
+        ndb.put_multi(game.update_active_games())
 
-        return StringMessage(message=message)
+        # Increment active count of games
+        taskqueue.add(url='/tasks/increment_active_games',
+                      transactional=True)
+        return game
 
-    @endpoints.method(request_message=GAME_REQUEST,
-                      response_message=GameForms,
-                      path='games/{urlsafe_game_key}/history',
-                      name='game_history',
-                      http_method='GET')
-    def game_history(self, request):
+    @staticmethod
+    def _users_by_name(names):
+        """Returns a dict of normalized name to User for every name. They
+        are fetched with one get_multi, Users that haven't been moved onto
+        a name-based key yet are found with a query. Raises a
+        NotFoundException if any name doesn't exist."""
+        normalized = sorted(set(User.normalize(name) for name in names))
+        users = dict(zip(normalized, ndb.get_multi(
+            [User.key_for(name) for name in normalized])))
+        for name in names:
+            if users[User.normalize(name)] is None:
+                user = User.get_by_name(name)
+                if not user:
+                    raise endpoints.NotFoundException(
+                        'User "{}" does not exist!'.format(name))
+                users[User.normalize(name)] = user
+        return users
+
+    @staticmethod
+    def _create_games(pairs, tournament=None):
+        """Creates a game for every (player one, player two, freak_factor)
+        and returns them. The game keys are allocated in one call and the
+        games, and the tournament if given, are written with one put_multi.
+        Each player's ActiveGames is then updated in its own transaction,
+        all of them running in parallel. A task queued before the write
+        repeats the updates later, so the index catches up even if they
+        fail or the request dies. The active games counter is incremented
+        by a single task."""
+        first, _ = Game.allocate_ids(len(pairs))
+        games = [Game.build(player_one, player_two, freak_factor,
+                            key=ndb.Key(Game, first + index))
+                 for index, (player_one, player_two, freak_factor)
+                 in enumerate(pairs)]
+        entities = list(games)
+        if tournament:
+            tournament.games = [game.key for game in games]
+            entities.append(tournament)
+
+        taskqueue.add(url='/tasks/add_active_games',
+                      params={'games': json.dumps([game.key.urlsafe()
+                                                   for game in games])},
+                      countdown=ADD_ACTIVE_GAMES_DELAY_SECONDS)
+        ndb.put_multi(entities)
+
+        futures = TicTacToeApi._add_to_active_games(games)
+        ndb.Future.wait_all(futures)
+        for future in futures:
+            try:
+                future.get_result()
+            except (datastore_errors.Error, apiproxy_errors.Error):
+                logging.exception('Updating ActiveGames failed, '
+                                  '/tasks/add_active_games will retry it')
+
+        taskqueue.add(url='/tasks/increment_active_games',
+                      params={'count': len(games)})
+        return games
+
+    @staticmethod
+    def add_active_games(game_keys):
+        """Adds games to their players' ActiveGames. Games that don't exist
+        or have ended are skipped. Raises if any update fails, so the task
+        calling it is retried."""
+        games = [game for game in ndb.get_multi(game_keys)
+                 if game is not None and not game.game_over]
+        futures = TicTacToeApi._add_to_active_games(games)
+        ndb.Future.wait_all(futures)
+        for future in futures:
+            future.get_result()
+
+    @staticmethod
+    def _add_to_active_games(games):
+        """Starts one transaction per player adding their games to their
+        ActiveGames. Returns the futures."""
+        added = {}
+        for game in games:
+            for user_key in set([game.player_one, game.player_two]):
+                added.setdefault(user_key, []).append(game.key)
+        return [TicTacToeApi._add_active_games_async(user_key, game_keys)
+                for user_key, game_keys in added.items()]
+
+    @staticmethod
+    @ndb.transactional_tasklet
+    def _add_active_games_async(user_key, game_keys):
+        active = yield ActiveGames.key_for(user_key).get_async()
+        if active is None:
+            return
+        if any([active.add(game_key) for game_key in game_keys]):
+            yield active.put_async()
+
+    @staticmethod
+    def _computer_user():
+        """Returns the User the computer plays as, creating it the first
+        time. Only its name-based key is looked up, so an old human User
+        named Computer is never picked."""
+        return User.get_or_insert(User.normalize(COMPUTER_NAME),
+                                  name=COMPUTER_NAME)
+
+    @staticmethod
+    def _plan_computer_replies(urlsafe_game_key, moves):
+        """Searches for the computer's replies to a list of (player_name,
+        row, col) moves before the move transaction starts, so retries of
+        the transaction don't search again. Uses the cached game. If it
+        turns out to be stale the transaction falls back to a short
+        search."""
+        game = cache.get_by_urlsafe(urlsafe_game_key, Game)
+        if not game:
+            return {}
+        return game.plan_computer_replies([(row, col)
+                                           for _, row, col in moves])
+
+    @staticmethod
+    def _build_active_games(user_key):
+        """Builds an ActiveGames for a user who doesn't have one by
+        querying their games. Returns it without putting it."""
+        active = ActiveGames(key=ActiveGames.key_for(user_key))
+        games = Game.query(ndb.AND(ndb.OR(Game.player_one == user_key,
+                                          Game.player_two == user_key),
+                                   Game.game_over == False))
+        for game in games:
+            active.add(game.key)
+        return active
 
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _apply_moves(urlsafe_game_key, moves, receipt_key=None,
+                     replies=None):
+        """Applies a list of (player_name, row, col) moves in a transaction
+        so that two requests for the same game can't overwrite each other.
+        Stops at the first move that can't be made or when the game ends.
+        The game and any changed Scores are written once, with a single
+        put_multi. Returns the game, a message and how many moves were
+        made. With a receipt_key the result is saved with the moves, and
+        if the receipt already exists they were made before so its message
+        is returned instead. replies are the computer's planned replies,
+        see Game.plan_computer_replies."""
+        game = get_by_urlsafe(urlsafe_game_key, Game)
         if not game:
             raise endpoints.NotFoundException('Game not found!')
 
-        game_history = GameHistory.query(ancestor=game.key).get()
+        if receipt_key:
+            receipt = receipt_key.get()
+            if receipt:
+                return game, receipt.message, 0
+
+        changed = []
+        message = None
+        made = 0
+        for player_name, row, col in moves:
+            if game.game_over:
+                message = 'Game already over!'
+                break
+
+            if not game.is_turn(player_name):
+                message = 'Please wait your turn!'
+                break
+
+            try:
+                game.load_move_log()
+                changed += game.move(row, col)
+            except ValueError as error:
+                message = error.message
+                break
+            made += 1
+            last_player = player_name
+
+            # The computer replies straight away, in the same transaction
+            if not game.game_over and game.is_computer_turn():
+                changed += game.computer_move(replies)
+                last_player = COMPUTER_NAME
+
+            # Any moves after the one that ended the game are ignored, so
+            # the win or draw message is the one returned
+            if game.game_over:
+                break
+
+        if not made:
+            return game, message, 0
+
+        message = message or game.last_message(last_player)
+        # ActiveGames only changes when the game ends, so ordinary moves
+        # don't touch the players' entity groups
+        entities = [game] + changed
+        if game.game_over:
+            entities += game.update_active_games()
+        if receipt_key:
+            entities.append(MoveReceipt(key=receipt_key, message=message))
+        ndb.put_multi(entities)
 
-        items = []
-        for index, item in enumerate(game_history.history):
-            items.append(item.to_form(game_history.messages[index]))
+        if game.game_over is True:
+            taskqueue.add(url='/tasks/decrement_active_games',
+                          transactional=True)
 
-        return GameForms(items=items)
+        return game, message, made
 
     @staticmethod
-    def increment_active_games():
+    @ndb.transactional(xg=True)
+    def _cancel(urlsafe_game_key):
+        """Cancels a game in a transaction so it can't race a move"""
+        game = get_by_urlsafe(urlsafe_game_key, Game)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
 
-        active_games = memcache.get(MEMCACHE_NUM_ACTIVE_GAMES)
-        if isinstance(active_games, int) is False:
-            active_games = Game.query(Game.game_over == False).count()
+        if game.game_over is True:
+            raise endpoints.ForbiddenException(
+                'You can not cancel this game as it is already over!')
 
-        memcache.set(MEMCACHE_NUM_ACTIVE_GAMES, active_games + 1)
+        # Save the game.
+        # A game with no winner and with game_over=True is a cancelled game.
+        game.load_move_log()
+        game.game_over = True
+        game.ended = datetime.datetime.utcnow()
+        game.record(movelog.CANCELLED)
+        ndb.put_multi([game] + game.update_active_games())
+
+        # Decrement active games
+        taskqueue.add(url='/tasks/decrement_active_games',
+                      transactional=True)
+
+        return game
 
     @staticmethod
-    def decrement_active_games():
-        active_games = memcache.get(MEMCACHE_NUM_ACTIVE_GAMES)
+    def increment_active_games(count=1):
+        counters.increment(ACTIVE_GAMES_COUNTER, count)
 
-        if isinstance(active_games, int) is False:
-            active_games = Game.query(Game.game_over == False).count()
+    @staticmethod
+    def decrement_active_games():
+        counters.increment(ACTIVE_GAMES_COUNTER, -1)
 
-        memcache.set(MEMCACHE_NUM_ACTIVE_GAMES, active_games - 1)
+    @staticmethod
+    def reconcile_active_games():
+        """Rebuilds the active games counter by counting the games"""
+        num_games = Game.query(Game.game_over == False).count()
+        counters.reset(ACTIVE_GAMES_COUNTER, num_games)
 
 
 api = endpoints.api_server([TicTacToeApi])
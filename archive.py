@@ -0,0 +1,212 @@
+"""archive.py - Cold storage for finished games.
+
+A daily cron moves games that ended more than ARCHIVE_AFTER_DAYS ago out of
+the Game kind, a batch per task. Each game is packed into one record (see
+gamerecord.py). Records are appended to a GameArchive part of the
+ArchiveDay for the date the game ended. The parts are compressed and kept
+under MAX_PART_BYTES. An ArchivedGame pointer keyed by the game's id
+records which part holds it and where its record starts. Then the Game and
+its children (legacy GameHistory, MoveReceipts) are deleted.
+
+get() rebuilds a Game from its record, so get_game and game_history work
+the same for archived games. The board is rebuilt by replaying the move
+log.
+
+A game is only deleted after its pointer is written. If a batch fails part
+way, the next run finds the pointer and just finishes the delete. A game
+that doesn't fit in a record, or whose players haven't been moved onto
+name-based keys yet, is logged and left in the Game kind, and each
+batch starts where the previous one stopped so such games can't hold the
+rest up."""
+
+import datetime
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import cache
+import gamerecord
+from models import ArchiveDay, ArchivedGame, Game, GameArchive
+from utils import key_from_urlsafe
+
+ARCHIVE_AFTER_DAYS = 30
+BATCH_SIZE = 100
+MAX_PART_BYTES = 800000
+
+BATCH_URL = '/tasks/archive_games'
+
+
+def _pack(game, players, player_index):
+    """Returns the record for a game, adding its players to the part's
+    players list as needed. Raises ValueError if it doesn't fit."""
+    return gamerecord.pack(gamerecord.Record(
+        game_id=game.key.id(),
+        player_one=game.player_one.urlsafe(),
+        player_two=game.player_two.urlsafe(),
+        winner=game.winner.urlsafe() if game.winner else None,
+        freak_factor=game.freak_factor,
+        rows=game.rows,
+        cols=game.cols,
+        winning_length=game.winning_length,
+        whos_turn=game.whos_turn,
+        version=game.version,
+        move_log=game.move_log), players, player_index)
+
+
+def _unpack(part, offset):
+    """Rebuilds the Game for the record at offset. The Game is never
+    put."""
+    record = gamerecord.unpack(part.data, offset, part.players)
+    bitboard = gamerecord.bitboard(record)
+    return Game(key=ndb.Key(Game, record.game_id),
+                player_one=ndb.Key(urlsafe=record.player_one),
+                player_two=ndb.Key(urlsafe=record.player_two),
+                winner=ndb.Key(urlsafe=record.winner)
+                if record.winner else None,
+                freak_factor=record.freak_factor,
+                rows=record.rows,
+                cols=record.cols,
+                winning_length=record.winning_length,
+                whos_turn=record.whos_turn,
+                board=bitboard.to_board(),
+                player_one_bits=bitboard.player_one,
+                player_two_bits=bitboard.player_two,
+                game_over=True,
+                move_log=record.move_log,
+                version=record.version)
+
+
+def get(game_key):
+    """Returns the archived Game for a key or None"""
+    pointer = cache.get(ArchivedGame.key_for(game_key))
+    if pointer is None:
+        return None
+
+    # Parts are too big to go through cache.py
+    part = pointer.part.get()
+    if part is None:
+        return None
+
+    # Pointers written before they had an offset need a scan
+    if pointer.offset is not None:
+        offsets = [pointer.offset]
+    else:
+        offsets = [offset for offset, game_id
+                   in gamerecord.records(part.data)
+                   if game_id == game_key.id()]
+    if not offsets:
+        return None
+    return _unpack(part, offsets[0])
+
+
+def get_by_urlsafe(urlsafe):
+    """Returns the Game for a urlsafe key, from the Game kind or the
+    archive, or None"""
+    return cache.get_by_urlsafe(urlsafe, Game) or \
+        get(key_from_urlsafe(urlsafe))
+
+
+def get_multi(game_keys):
+    """Like ndb.get_multi for Game keys, falling back to the archive for
+    the ones that aren't in the Game kind"""
+    return [game or get(key)
+            for game, key in zip(ndb.get_multi(game_keys), game_keys)]
+
+
+@ndb.transactional
+def _append(day, games):
+    """Appends games to the day's newest part, starting a new part when it
+    is full. Games it already holds are skipped. Returns the part's key and
+    a dict of game id to the offset of its record."""
+    day_key = ndb.Key(ArchiveDay, day)
+    archive_day = day_key.get() or ArchiveDay(key=day_key, parts=0)
+    part = ndb.Key(GameArchive, archive_day.parts, parent=day_key).get() \
+        if archive_day.parts else None
+
+    if part is None or len(part.data) + \
+            sum(len(player) for player in part.players) > MAX_PART_BYTES:
+        archive_day.parts += 1
+        part = GameArchive(key=ndb.Key(GameArchive, archive_day.parts,
+                                       parent=day_key))
+
+    data = part.data or b''
+    offsets = dict((game_id, offset)
+                   for offset, game_id in gamerecord.records(data))
+    player_index = dict((player, index)
+                        for index, player in enumerate(part.players))
+    records = []
+    for game in games:
+        if game.key.id() not in offsets:
+            offsets[game.key.id()] = len(data) + sum(map(len, records))
+            records.append(_pack(game, part.players, player_index))
+    part.data = data + b''.join(records)
+
+    ndb.put_multi([archive_day, part])
+    return part.key, offsets
+
+
+def _can_archive(game):
+    """Check if a game can be archived. Records keep the players' keys and
+    are never re-pointed, so both players must already be keyed by name
+    (see /tasks/migrate_users). Games created before new_game checked
+    freak_factor may not fit in a record."""
+    for player in (game.player_one, game.player_two):
+        if not isinstance(player.id(), basestring):
+            logging.warning('Not archiving game %s until %s is migrated',
+                            game.key, player)
+            return False
+
+    try:
+        _pack(game, [], {})
+    except ValueError:
+        logging.exception('Not archiving game %s, it does not fit in a '
+                          'record', game.key)
+        return False
+    return True
+
+
+def archive_batch(cursor=None):
+    """Archives the next batch of games that ended before the cutoff, then
+    queues the batch after it. cursor is where the previous batch stopped,
+    so games that can't be archived are passed over."""
+    cutoff = datetime.datetime.utcnow() - \
+        datetime.timedelta(days=ARCHIVE_AFTER_DAYS)
+    games, next_cursor, more = Game.query(Game.ended < cutoff).fetch_page(
+        BATCH_SIZE, start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+    if not games:
+        return
+
+    pointers = ndb.get_multi([ArchivedGame.key_for(game.key)
+                              for game in games])
+    archived = []
+    by_day = {}
+    for game, pointer in zip(games, pointers):
+        if pointer is None:
+            game.load_move_log()
+            if not _can_archive(game):
+                continue
+            by_day.setdefault(game.ended.strftime('%Y%m%d'), []).append(game)
+        archived.append(game)
+    games = archived
+
+    new_pointers = []
+    for day, day_games in sorted(by_day.items()):
+        part_key, offsets = _append(day, day_games)
+        new_pointers += [ArchivedGame(key=ArchivedGame.key_for(game.key),
+                                      part=part_key,
+                                      offset=offsets[game.key.id()])
+                         for game in day_games]
+    ndb.put_multi(new_pointers)
+
+    # A kindless ancestor query finds the game along with its children
+    futures = [ndb.Query(ancestor=game.key).fetch_async(keys_only=True)
+               for game in games]
+    ndb.delete_multi([key for future in futures
+                      for key in future.get_result()])
+    for game in games:
+        cache.invalidate(game.key)
+
+    if more and next_cursor:
+        taskqueue.add(url=BATCH_URL, params={'cursor': next_cursor.urlsafe()})
@@ -0,0 +1,68 @@
+"""bench_boards.py - Compares the board formats GameForm.board can use. For
+every board size new_game can make it prints the size of the board field
+once it is embedded in a JSON response and the time to encode and decode
+it. Run with 'python bench_boards.py'."""
+
+import json
+import random
+import timeit
+
+from engine import Bitboard, PLAYER_ONE, PLAYER_TWO
+
+REPEAT = 5
+NUMBER = 2000
+
+
+def half_played(rows, cols, winning_length):
+    """Returns a board with about half of the cells marked"""
+    rng = random.Random(rows * cols)
+    bitboard = Bitboard(rows, cols, winning_length)
+    cells = [(row, col) for row in range(rows) for col in range(cols)]
+    rng.shuffle(cells)
+    for turn, (row, col) in enumerate(cells[:len(cells) // 2]):
+        bitboard.mark(PLAYER_ONE if turn % 2 == 0 else PLAYER_TWO, row, col)
+    return bitboard
+
+
+def formats(rows, cols, winning_length):
+    """Returns (name, encode, decode) for each format"""
+    return [
+        ('json',
+         lambda bitboard: json.dumps(bitboard.to_board()),
+         lambda board: Bitboard.from_board(json.loads(board),
+                                           winning_length)),
+        ('flat',
+         lambda bitboard: bitboard.to_flat(),
+         lambda board: Bitboard.from_flat(board, rows, cols,
+                                          winning_length)),
+        ('packed',
+         lambda bitboard: bitboard.to_packed(),
+         lambda board: Bitboard.from_packed(board, rows, cols,
+                                            winning_length)),
+    ]
+
+
+def best_microseconds(func):
+    return min(timeit.repeat(func, repeat=REPEAT, number=NUMBER)) / \
+        NUMBER * 1e6
+
+
+def main():
+    print('{:<6} {:<7} {:>11} {:>11} {:>11}'.format(
+        'board', 'format', 'bytes', 'encode us', 'decode us'))
+    for rows, cols, winning_length in ((3, 3, 3), (4, 4, 3), (5, 5, 3)):
+        bitboard = half_played(rows, cols, winning_length)
+        for name, encode, decode in formats(rows, cols, winning_length):
+            board = encode(bitboard)
+            assert decode(board).to_board() == bitboard.to_board()
+
+            # The size of the field as it appears in the JSON response
+            size = len(json.dumps({'board': board}))
+            print('{:<6} {:<7} {:>11} {:>11.2f} {:>11.2f}'.format(
+                '{}x{}'.format(rows, cols), name, size,
+                best_microseconds(lambda: encode(bitboard)),
+                best_microseconds(lambda: decode(board))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""bench_solver.py - Measures the computer opponent's search. For every board
+shape new_game can make it prints the nodes searched per second and the
+time to pick a move from the empty board and from a few undecided positions
+part way through a game. The opening book is not used. Run with
+'python bench_solver.py'."""
+
+import random
+import time
+
+from engine import Bitboard, NEW_GAME_SHAPES, ONGOING, PLAYER_ONE, \
+    PLAYER_TWO
+from solver import DEFAULT_BUDGET_SECONDS, Solver
+
+POSITIONS = 5
+
+# Random games tried for each position before giving up on it
+ATTEMPTS = 1000
+
+
+def random_position(rng, rows, cols, winning_length, marks):
+    """Plays marks random legal moves. Returns (mover, other) for the player
+    to move, or None if the game ended or the player to move can win
+    straight away, since the solver answers those without searching."""
+    bitboard = Bitboard(rows, cols, winning_length)
+    cells = [(row, col) for row in range(rows) for col in range(cols)]
+    rng.shuffle(cells)
+    for turn, (row, col) in enumerate(cells[:marks]):
+        player = PLAYER_ONE if turn % 2 == 0 else PLAYER_TWO
+        if bitboard.play(player, row, col) != ONGOING:
+            return None
+
+    player = PLAYER_ONE if marks % 2 == 0 else PLAYER_TWO
+    mover = bitboard.bits(player)
+    other = bitboard.occupied() & ~mover
+    solver = Solver(rows, cols, winning_length, table={})
+    for row, col in cells[marks:]:
+        cell = row * cols + col
+        if solver.wins(mover | 1 << cell, cell):
+            return None
+    return mover, other
+
+
+def positions(rows, cols, winning_length):
+    """Yields (mover, other) for the empty board and a few undecided
+    positions with some marks on it"""
+    yield 0, 0
+    rng = random.Random(rows * cols)
+    for marks in range(2, min(2 + 2 * POSITIONS, rows * cols), 2):
+        for _ in range(ATTEMPTS):
+            position = random_position(rng, rows, cols, winning_length,
+                                       marks)
+            if position is not None:
+                yield position
+                break
+
+
+def main():
+    print('{:<8} {:>6} {:>10} {:>12} {:>10}'.format(
+        'board', 'marks', 'nodes', 'nodes/sec', 'move ms'))
+    for rows, cols, winning_length in sorted(NEW_GAME_SHAPES):
+        for mover, other in positions(rows, cols, winning_length):
+            solver = Solver(rows, cols, winning_length, table={})
+            start = time.time()
+            solver.best_move(mover, other, DEFAULT_BUDGET_SECONDS)
+            elapsed = time.time() - start
+            print('{:<8} {:>6} {:>10} {:>12.0f} {:>10.1f}'.format(
+                '{}x{}/{}'.format(rows, cols, winning_length),
+                bin(mover | other).count('1'), solver.nodes,
+                solver.nodes / max(elapsed, 1e-6), elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""cache.py - Read-through cache for hot entities such as the Game a client
+is polling. There are two tiers: a bounded LRU in the instance's memory and
+memcache, shared by every instance. A read fetches the version first and
+only goes to memcache for the entity when the local copy is missing or
+out of date.
+
+Every cached entity has a version number in memcache. Cached copies are
+tagged with the version that was current when they were read from the
+datastore and are only used while it still matches. invalidate() bumps the
+version after a write so no instance serves the old copy again.
+
+Reads inside a transaction must go to the datastore, so don't use this
+there."""
+
+import collections
+import pickle
+import threading
+import time
+
+from google.appengine.api import memcache
+
+from utils import check_kind, key_from_urlsafe
+
+LOCAL_CACHE_SIZE = 500
+
+# How long a cached copy can be used. Bounds how stale an entity can get if
+# a request dies between its commit and invalidate().
+ENTITY_SECONDS = 300
+
+_stats = collections.Counter()
+
+
+class LRU(object):
+    """A bounded map held in the instance's memory that drops the least
+    recently used entry when it is full. Safe to share between request
+    threads. None can't be stored as a value."""
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the value for key or None"""
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                # Re-insert to mark it as the most recently used
+                self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+_local = LRU(LOCAL_CACHE_SIZE)
+
+
+def _version_key(key):
+    return 'entity-version-' + key.urlsafe()
+
+
+def _entity_key(key):
+    return 'entity-' + key.urlsafe()
+
+
+def _current_version(key, version):
+    """Returns the entity's version, starting one if memcache doesn't have
+    it. New versions start from the current time in milliseconds so they
+    are past any version handed out before memcache lost the old one."""
+    if version is None:
+        memcache.add(_version_key(key), int(time.time() * 1000))
+        version = memcache.get(_version_key(key))
+    return version
+
+
+def _get_local(key, version):
+    cached = _local.get(key)
+    if cached is None or cached[0] != version or cached[2] < time.time():
+        return None
+    return cached[1]
+
+
+def _set_local(key, version, data):
+    _local.set(key, (version, data, time.time() + ENTITY_SECONDS))
+
+
+def get(key):
+    """Returns the entity for a key or None if it doesn't exist. Each call
+    returns a separate copy that is safe to modify."""
+    version = _current_version(key, memcache.get(_version_key(key)))
+    if version is None:
+        # memcache is unavailable
+        _stats['misses'] += 1
+        return key.get()
+
+    # Only the small version stamp is read until the local copy misses
+    data = _get_local(key, version)
+    if data is not None:
+        _stats['local_hits'] += 1
+        return pickle.loads(data)
+
+    shared = memcache.get(_entity_key(key))
+    if shared is not None and shared[0] == version:
+        _stats['memcache_hits'] += 1
+        _set_local(key, version, shared[1])
+        return pickle.loads(shared[1])
+
+    _stats['misses'] += 1
+    entity = key.get()
+    if entity is not None:
+        data = pickle.dumps(entity, pickle.HIGHEST_PROTOCOL)
+        memcache.set(_entity_key(key), (version, data), time=ENTITY_SECONDS)
+        _set_local(key, version, data)
+    return entity
+
+
+def get_by_urlsafe(urlsafe, model):
+    """Cached version of utils.get_by_urlsafe"""
+    return check_kind(get(key_from_urlsafe(urlsafe)), model)
+
+
+def invalidate(key):
+    """Stops every instance from using its cached copy of an entity. Call
+    after the write has been committed."""
+    memcache.incr(_version_key(key))
+    _local.pop(key)
+
+
+def stats():
+    """Returns this instance's hit and miss counts"""
+    return dict(_stats)
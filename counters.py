@@ -0,0 +1,63 @@
+"""counters.py - Sharded counters. Each counter is spread over NUM_SHARDS
+CounterShard entities so concurrent updates rarely contend. Every update
+goes to one random shard in a transaction. The total is cached in memcache
+and kept current with memcache.incr/decr."""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import CounterShard
+
+NUM_SHARDS = 20
+
+
+def _cache_key(name):
+    return 'counter-' + name
+
+
+def _shard_keys(name):
+    return [ndb.Key(CounterShard, '{}-{}'.format(name, index))
+            for index in range(NUM_SHARDS)]
+
+
+def get_count(name):
+    """Returns the value of a counter. A cache miss reads all of the shards
+    with a single get_multi."""
+    total = memcache.get(_cache_key(name))
+    if total is None:
+        total = sum(shard.count for shard in ndb.get_multi(_shard_keys(name))
+                    if shard is not None)
+        memcache.add(_cache_key(name), total)
+    return total
+
+
+def increment(name, delta=1):
+    """Adds delta (which may be negative) to a counter"""
+    _increment_shard(random.choice(_shard_keys(name)), delta)
+
+    # Only adjust the cached total if there is one. A missing total is
+    # rebuilt from the shards on the next read.
+    if delta >= 0:
+        memcache.incr(_cache_key(name), delta=delta)
+    else:
+        memcache.decr(_cache_key(name), delta=-delta)
+
+
+@ndb.transactional
+def _increment_shard(key, delta):
+    shard = key.get()
+    if shard is None:
+        shard = CounterShard(key=key, count=0)
+    shard.count += delta
+    shard.put()
+
+
+def reset(name, value):
+    """Overwrites a counter with value. Used to rebuild a counter from the
+    data it is counting."""
+    shards = [CounterShard(key=key, count=0) for key in _shard_keys(name)]
+    shards[0].count = value
+    ndb.put_multi(shards)
+    memcache.set(_cache_key(name), value)
@@ -0,0 +1,268 @@
+"""engine.py - Bitboard representation of the game board and the rules
+that operate on it. Nothing in here depends on the App Engine runtime so the
+rules can be exercised on their own.
+
+A board is stored as one integer bitmask per player. The cell at (row, col)
+is bit (row * cols + col)."""
+
+import base64
+
+PLAYER_ONE = 1
+PLAYER_TWO = 2
+
+# (row step, col step) for horizontal, vertical, diagonal and anti-diagonal
+DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+# Outcomes of Bitboard.play
+ONGOING = 0
+WON = 1
+DRAW = 2
+
+_WIN_MASKS = {}
+
+
+def dimensions(freak_factor):
+    """Returns the (rows, cols, winning_length) of a board for the given
+    freak_factor"""
+
+    # Change number of rows and cols based on freak_factor
+    if freak_factor % 3 == 0:
+        rows = 5
+        cols = 5
+    elif freak_factor % 2 == 0:
+        rows = 4
+        cols = 4
+    else:
+        rows = 3
+        cols = 3
+
+    # Freak factor >= 10 means take the smallest axis and make that
+    # the winning length
+    if freak_factor >= 10:
+        winning_length = min(rows, cols)
+    else:
+        winning_length = 3
+
+    return rows, cols, winning_length
+
+
+def cell_bit(row, col, cols):
+    """Returns the bit for a single cell"""
+    return 1 << (row * cols + col)
+
+
+def popcount(bits):
+    """Returns the number of set bits"""
+    return bin(bits).count('1')
+
+
+def win_masks(rows, cols, winning_length):
+    """Returns a tuple holding one bitmask for every line of winning_length
+    cells on a rows x cols board. Masks are built once per board shape."""
+    shape = (rows, cols, winning_length)
+    masks = _WIN_MASKS.get(shape)
+    if masks is None:
+        masks = tuple(_build_win_masks(rows, cols, winning_length))
+        _WIN_MASKS[shape] = masks
+    return masks
+
+
+def _build_win_masks(rows, cols, winning_length):
+    reach = winning_length - 1
+    for row in range(rows):
+        for col in range(cols):
+            for row_step, col_step in DIRECTIONS:
+                end_row = row + row_step * reach
+                end_col = col + col_step * reach
+                if not (0 <= end_row < rows and 0 <= end_col < cols):
+                    continue
+
+                mask = 0
+                for step in range(winning_length):
+                    mask |= cell_bit(row + row_step * step,
+                                     col + col_step * step,
+                                     cols)
+                yield mask
+
+
+class Bitboard(object):
+    """Both players' marks for a single board"""
+    __slots__ = ('rows', 'cols', 'winning_length', 'player_one',
+                 'player_two')
+
+    def __init__(self, rows, cols, winning_length, player_one=0,
+                 player_two=0):
+        self.rows = rows
+        self.cols = cols
+        self.winning_length = winning_length
+        self.player_one = player_one
+        self.player_two = player_two
+
+    @classmethod
+    def from_board(cls, board, winning_length):
+        """Builds a Bitboard from a list-of-lists board as stored in
+        Game.board"""
+        rows = len(board)
+        cols = len(board[0]) if rows else 0
+        player_one = 0
+        player_two = 0
+        for row, cells in enumerate(board):
+            for col, cell in enumerate(cells):
+                if cell == PLAYER_ONE:
+                    player_one |= cell_bit(row, col, cols)
+                elif cell == PLAYER_TWO:
+                    player_two |= cell_bit(row, col, cols)
+        return cls(rows, cols, winning_length, player_one, player_two)
+
+    def to_board(self):
+        """Returns the list-of-lists representation of the board"""
+        board = []
+        bit = 1
+        for _ in range(self.rows):
+            row = []
+            for _ in range(self.cols):
+                if self.player_one & bit:
+                    row.append(PLAYER_ONE)
+                elif self.player_two & bit:
+                    row.append(PLAYER_TWO)
+                else:
+                    row.append(0)
+                bit <<= 1
+            board.append(row)
+        return board
+
+    def to_flat(self):
+        """Returns the board as a string with one character ('0', '1' or
+        '2') per cell, row by row"""
+        cells = []
+        for cell in range(self.rows * self.cols):
+            bit = 1 << cell
+            if self.player_one & bit:
+                cells.append('1')
+            elif self.player_two & bit:
+                cells.append('2')
+            else:
+                cells.append('0')
+        return ''.join(cells)
+
+    @classmethod
+    def from_flat(cls, flat, rows, cols, winning_length):
+        """Builds a Bitboard from the output of to_flat"""
+        player_one = 0
+        player_two = 0
+        for cell, value in enumerate(flat):
+            if value == '1':
+                player_one |= 1 << cell
+            elif value == '2':
+                player_two |= 1 << cell
+        return cls(rows, cols, winning_length, player_one, player_two)
+
+    def to_packed(self):
+        """Returns the board as urlsafe base64 with 2 bits per cell. Cell 0
+        is the lowest 2 bits of the first byte."""
+        packed = bytearray((self.rows * self.cols + 3) // 4)
+        for cell in range(self.rows * self.cols):
+            bit = 1 << cell
+            if self.player_one & bit:
+                packed[cell // 4] |= PLAYER_ONE << (cell % 4 * 2)
+            elif self.player_two & bit:
+                packed[cell // 4] |= PLAYER_TWO << (cell % 4 * 2)
+        return base64.urlsafe_b64encode(bytes(packed)).decode('ascii')
+
+    @classmethod
+    def from_packed(cls, packed, rows, cols, winning_length):
+        """Builds a Bitboard from the output of to_packed"""
+        data = bytearray(base64.urlsafe_b64decode(str(packed)))
+        player_one = 0
+        player_two = 0
+        for cell in range(rows * cols):
+            value = data[cell // 4] >> (cell % 4 * 2) & 3
+            if value == PLAYER_ONE:
+                player_one |= 1 << cell
+            elif value == PLAYER_TWO:
+                player_two |= 1 << cell
+        return cls(rows, cols, winning_length, player_one, player_two)
+
+    def bits(self, player):
+        """Returns the bitmask for a player"""
+        return self.player_one if player == PLAYER_ONE else self.player_two
+
+    def occupied(self):
+        """Returns the bitmask of every marked cell"""
+        return self.player_one | self.player_two
+
+    def on_board(self, row, col):
+        return 0 <= row < self.rows and 0 <= col < self.cols
+
+    def is_free(self, row, col):
+        return not self.occupied() & cell_bit(row, col, self.cols)
+
+    def mark(self, player, row, col):
+        """Marks a cell for a player"""
+        if player == PLAYER_ONE:
+            self.player_one |= cell_bit(row, col, self.cols)
+        else:
+            self.player_two |= cell_bit(row, col, self.cols)
+
+    def has_won(self, player):
+        """Check if a player has any complete line"""
+        bits = self.bits(player)
+        for mask in win_masks(self.rows, self.cols, self.winning_length):
+            if bits & mask == mask:
+                return True
+        return False
+
+    def wins_through(self, player, row, col):
+        """Check if the player has a complete line passing through
+        (row, col). Only the four lines through that cell are walked so the
+        cost is O(winning_length) rather than a scan of the whole board."""
+        bits = self.bits(player)
+        cols = self.cols
+        for row_step, col_step in DIRECTIONS:
+            in_line = 1
+
+            # Walk forwards then backwards from the cell along the line
+            for sign in (1, -1):
+                next_row = row + row_step * sign
+                next_col = col + col_step * sign
+                while 0 <= next_row < self.rows and \
+                        0 <= next_col < cols and \
+                        bits & cell_bit(next_row, next_col, cols):
+                    in_line += 1
+                    next_row += row_step * sign
+                    next_col += col_step * sign
+
+            if in_line >= self.winning_length:
+                return True
+        return False
+
+    def is_full(self):
+        """Check if every cell has been marked"""
+        return popcount(self.occupied()) == self.rows * self.cols
+
+    def play(self, player, row, col):
+        """Applies a move for a player. Raises ValueError if the cell can't
+        be played, otherwise returns WON, DRAW or ONGOING."""
+        if not self.on_board(row, col):
+            raise ValueError(
+                "You can not move here. That's not even a spot on the board!")
+
+        if not self.is_free(row, col):
+            raise ValueError(
+                "You can not move here. This space is already taken!")
+
+        self.mark(player, row, col)
+        if self.wins_through(player, row, col):
+            return WON
+        if self.is_full():
+            return DRAW
+        return ONGOING
+
+
+# Every board shape Game.new_game can produce. The freak_factor pattern
+# repeats every 6 values and switches winning_length at 10, so 0-15 covers
+# all of them.
+NEW_GAME_SHAPES = frozenset(dimensions(ff) for ff in range(16))
+
+for _shape in NEW_GAME_SHAPES:
+    win_masks(*_shape)
@@ -0,0 +1,91 @@
+"""gamerecord.py - The packed form of a finished game kept by archive.py. A
+record is a fixed size header followed by the game's move log. Players are
+written as indexes into a list kept alongside the records, so a part holding
+many games between the same players only names each of them once. Like
+movelog.py this doesn't need the App Engine runtime."""
+
+import collections
+import struct
+
+import movelog
+from engine import Bitboard
+
+# game id, player one, player two, winner (indexes into the players list),
+# freak_factor, rows, cols, winning_length, whos_turn, version and the
+# length of the move log that follows
+_HEADER = struct.Struct('<qIIIiBBBBIH')
+NO_WINNER = 0xFFFFFFFF
+
+Record = collections.namedtuple('Record', [
+    'game_id', 'player_one', 'player_two', 'winner', 'freak_factor', 'rows',
+    'cols', 'winning_length', 'whos_turn', 'version', 'move_log'])
+
+
+def pack(record, players, player_index):
+    """Returns the bytes for a Record. winner may be None. Players not in
+    player_index (player to index into players) are added to both. Raises
+    ValueError if a field doesn't fit in the header, and then players and
+    player_index are left as they were."""
+    added = len(players)
+
+    def index(player):
+        if player is None:
+            return NO_WINNER
+        if player not in player_index:
+            player_index[player] = len(players)
+            players.append(player)
+        return player_index[player]
+
+    log = record.move_log or b''
+    try:
+        header = _HEADER.pack(record.game_id, index(record.player_one),
+                              index(record.player_two),
+                              index(record.winner), record.freak_factor,
+                              record.rows, record.cols,
+                              record.winning_length, record.whos_turn,
+                              record.version or 0, len(log))
+    except struct.error as error:
+        for player in players[added:]:
+            del player_index[player]
+        del players[added:]
+        raise ValueError('Game {} does not fit in a record: {}'.format(
+            record.game_id, error))
+    return header + log
+
+
+def records(data):
+    """Yields (offset, game id) for every record in data"""
+    offset = 0
+    while offset < len(data):
+        header = _HEADER.unpack_from(data, offset)
+        yield offset, header[0]
+        offset += _HEADER.size + header[-1]
+
+
+def unpack(data, offset, players):
+    """Returns the Record starting at offset in data"""
+    header = _HEADER.unpack_from(data, offset)
+    (game_id, player_one, player_two, winner, freak_factor, rows, cols,
+     winning_length, whos_turn, version, log_length) = header
+    start = offset + _HEADER.size
+    return Record(game_id=game_id,
+                  player_one=players[player_one],
+                  player_two=players[player_two],
+                  winner=players[winner] if winner != NO_WINNER else None,
+                  freak_factor=freak_factor,
+                  rows=rows,
+                  cols=cols,
+                  winning_length=winning_length,
+                  whos_turn=whos_turn,
+                  version=version,
+                  move_log=data[start:start + log_length])
+
+
+def bitboard(record):
+    """Returns the Record's final board, rebuilt by replaying its move
+    log"""
+    board = Bitboard(record.rows, record.cols, record.winning_length)
+    for row, col, player, _ in movelog.entries(record.move_log):
+        if row != movelog.NO_CELL:
+            board.mark(player, row, col)
+    return board
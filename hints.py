@@ -0,0 +1,122 @@
+"""hints.py - Suggested moves for get_hint. Searches are cached by board
+shape and canonical position (see solver.py), so every rotation and
+reflection of a position shares one entry and common positions are only
+searched once across all games.
+
+There are three tiers: a bounded LRU in the instance's memory, memcache and
+SolvedPosition entities. A miss is filled from the tier below and copied
+into the tiers above it. Entries hold a move for the canonical orientation,
+which is mapped back onto the board being asked about.
+
+Only positions the search fully solved are kept for good. A search that ran
+out of time is only kept in memcache for UNSOLVED_SECONDS, so the position
+is searched again later instead of serving a guess forever."""
+
+import collections
+
+from google.appengine.api import memcache
+
+import solver
+from cache import LRU
+from models import SolvedPosition
+
+LOCAL_CACHE_SIZE = 5000
+UNSOLVED_SECONDS = 600
+
+_local = LRU(LOCAL_CACHE_SIZE)
+_stats = collections.Counter()
+
+
+def _position_id(bitboard, key):
+    return '{}x{}x{}-{:x}'.format(bitboard.rows, bitboard.cols,
+                                  bitboard.winning_length, key)
+
+
+def _memcache_key(position_id):
+    return 'solved-' + position_id
+
+
+def _lookup(position_id):
+    """Returns the cached (move, score, solved) or None"""
+    entry = _local.get(position_id)
+    if entry is not None:
+        _stats['local_hits'] += 1
+        return entry
+
+    entry = memcache.get(_memcache_key(position_id))
+    if entry is not None:
+        _stats['memcache_hits'] += 1
+        if entry[2]:
+            _local.set(position_id, entry)
+        return entry
+
+    # Unsolved positions saved by older versions are searched again
+    position = SolvedPosition.get_by_id(position_id)
+    if position is not None and position.solved:
+        _stats['datastore_hits'] += 1
+        entry = (position.move, position.score, position.solved)
+        memcache.set(_memcache_key(position_id), entry)
+        _local.set(position_id, entry)
+        return entry
+
+    return None
+
+
+def _search(bitboard, mover, other, cell_map, position_id):
+    """Searches a position and saves the result in every tier if it was
+    solved, otherwise only briefly in memcache"""
+    _stats['searches'] += 1
+    search = solver.Solver(bitboard.rows, bitboard.cols,
+                           bitboard.winning_length)
+    score, cell = search.best_move(mover, other)
+
+    entry = (cell_map[cell], score, search.solved)
+    if not search.solved:
+        memcache.set(_memcache_key(position_id), entry,
+                     time=UNSOLVED_SECONDS)
+        return entry
+
+    SolvedPosition(id=position_id, move=entry[0], score=score,
+                   solved=True).put()
+    memcache.set(_memcache_key(position_id), entry)
+    _local.set(position_id, entry)
+    return entry
+
+
+def hint(bitboard, player):
+    """Returns (row, col, outlook) of the suggested move for player.
+    outlook is 'win', 'loss' or 'draw' for a solved position and 'unclear'
+    otherwise."""
+    mover = bitboard.bits(player)
+    other = bitboard.occupied() & ~mover
+    key, symmetry = solver.canonical(bitboard.rows, bitboard.cols,
+                                     mover, other)
+    cell_map = solver.symmetries(bitboard.rows, bitboard.cols)[symmetry][1]
+    position_id = _position_id(bitboard, key)
+
+    entry = _lookup(position_id)
+    if entry is None:
+        entry = _search(bitboard, mover, other, cell_map, position_id)
+
+    move, score, solved = entry
+    if not solved:
+        outlook = 'unclear'
+    elif score >= solver.WIN_SCORE:
+        outlook = 'win'
+    elif score <= -solver.WIN_SCORE:
+        outlook = 'loss'
+    else:
+        outlook = 'draw'
+
+    row, col = divmod(cell_map.index(move), bitboard.cols)
+    return row, col, outlook
+
+
+def stats():
+    """Returns this instance's hit counts per tier, the number of searches
+    and the overall hit rate"""
+    counts = dict(_stats)
+    lookups = sum(counts.values())
+    counts['hit_rate'] = round(
+        1 - float(counts.get('searches', 0)) / lookups, 3) if lookups else 0
+    return counts
@@ -0,0 +1,206 @@
+"""instrumentation.py - Per-endpoint latency and RPC counts.
+
+@instrumented wraps an API method. While it runs, an apiproxy hook counts
+the datastore and memcache RPCs the request thread makes. When it returns
+one structured log line is written and the numbers are added to rolling
+histograms held by this instance, which stats() reports. Measuring a
+response's size means encoding it again, so only one call in
+RESPONSE_SIZE_SAMPLE is measured.
+
+Hooks see every RPC, so gets and queries made by ndb, the cache module and
+the task queue are all counted without touching the code that makes them."""
+
+import collections
+import json
+import logging
+import random
+import threading
+import time
+from functools import wraps
+
+from google.appengine.api import apiproxy_stub_map
+from protorpc import protojson
+
+import cache
+import hints
+
+WINDOW_SECONDS = 600
+SLOT_SECONDS = 60
+
+# Upper bounds of the latency histogram buckets, the last one is open ended
+LATENCY_BOUNDS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+RESPONSE_SIZE_SAMPLE = 20
+
+COUNTERS = ('datastore_gets', 'datastore_puts', 'datastore_queries',
+            'datastore_rpcs', 'memcache_hits', 'memcache_misses',
+            'memcache_rpcs')
+
+_current = threading.local()
+_lock = threading.Lock()
+
+# {slot start: {method name: _Histogram}}
+_slots = collections.OrderedDict()
+
+
+class _Histogram(object):
+    """Counts for one method in one slot"""
+
+    __slots__ = ('calls', 'errors', 'total_ms', 'buckets', 'counters')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BOUNDS_MS) + 1)
+        self.counters = collections.Counter()
+
+    def add(self, wall_ms, counters, error):
+        self.calls += 1
+        self.errors += 1 if error else 0
+        self.total_ms += wall_ms
+        self.buckets[_bucket(wall_ms)] += 1
+        self.counters.update(counters)
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.errors += other.errors
+        self.total_ms += other.total_ms
+        self.buckets = [mine + theirs for mine, theirs
+                        in zip(self.buckets, other.buckets)]
+        self.counters.update(other.counters)
+
+
+def _bucket(wall_ms):
+    for index, bound in enumerate(LATENCY_BOUNDS_MS):
+        if wall_ms <= bound:
+            return index
+    return len(LATENCY_BOUNDS_MS)
+
+
+def _rpc_hook(service, call, request, response, rpc=None):
+    counters = getattr(_current, 'counters', None)
+    if counters is None:
+        return
+
+    if service == 'datastore_v3':
+        counters['datastore_rpcs'] += 1
+        if call == 'Get':
+            counters['datastore_gets'] += request.key_size()
+        elif call == 'Put':
+            counters['datastore_puts'] += request.entity_size()
+        elif call == 'RunQuery':
+            counters['datastore_queries'] += 1
+    elif service == 'memcache':
+        counters['memcache_rpcs'] += 1
+        if call == 'Get':
+            hits = response.item_size()
+            counters['memcache_hits'] += hits
+            counters['memcache_misses'] += request.key_size() - hits
+
+
+def install():
+    """Adds the RPC hook to the current apiproxy. Safe to call again, for
+    instance after a testbed has replaced the apiproxy."""
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'instrumentation', _rpc_hook)
+
+
+def _record(method, wall_ms, counters, error):
+    slot = int(time.time()) // SLOT_SECONDS * SLOT_SECONDS
+    with _lock:
+        methods = _slots.get(slot)
+        if methods is None:
+            methods = _slots[slot] = {}
+            while next(iter(_slots)) <= slot - WINDOW_SECONDS:
+                _slots.popitem(last=False)
+        histogram = methods.get(method)
+        if histogram is None:
+            histogram = methods[method] = _Histogram()
+        histogram.add(wall_ms, counters, error)
+
+
+def instrumented(func):
+    """Decorator for API methods. Goes below @endpoints.method."""
+
+    @wraps(func)
+    def wrapper(self, request):
+        _current.counters = counters = collections.Counter()
+        start = time.time()
+        status = 200
+        try:
+            response = func(self, request)
+            if not random.randrange(RESPONSE_SIZE_SAMPLE):
+                counters['response_bytes'] = len(
+                    protojson.encode_message(response))
+                counters['sized_responses'] = 1
+            return response
+        except Exception as e:
+            status = getattr(e, 'http_status', 500)
+            raise
+        finally:
+            _current.counters = None
+            wall_ms = (time.time() - start) * 1000
+            _record(func.__name__, wall_ms, counters, status >= 400)
+            line = dict(counters, method=func.__name__, status=status,
+                        wall_ms=round(wall_ms, 2))
+            logging.info('api_call %s', json.dumps(line, sort_keys=True))
+
+    return wrapper
+
+
+def _percentile(buckets, calls, percent):
+    """Returns the upper bound of the bucket holding the percentile, or
+    None if it is in the open ended one"""
+    wanted = percent / 100.0 * calls
+    seen = 0
+    for index, count in enumerate(buckets):
+        seen += count
+        if seen >= wanted:
+            return LATENCY_BOUNDS_MS[index] \
+                if index < len(LATENCY_BOUNDS_MS) else None
+    return None
+
+
+def stats():
+    """Returns this instance's numbers for the last WINDOW_SECONDS as a
+    dict that can be written out as JSON"""
+    oldest = time.time() - WINDOW_SECONDS
+    merged = collections.defaultdict(_Histogram)
+    with _lock:
+        for slot, methods in _slots.items():
+            if slot + SLOT_SECONDS <= oldest:
+                continue
+            for method, histogram in methods.items():
+                merged[method].merge(histogram)
+
+    methods = {}
+    for method, histogram in merged.items():
+        calls = histogram.calls
+        methods[method] = {
+            'calls': calls,
+            'errors': histogram.errors,
+            'mean_ms': round(histogram.total_ms / calls, 2),
+            'p50_ms': _percentile(histogram.buckets, calls, 50),
+            'p95_ms': _percentile(histogram.buckets, calls, 95),
+            'p99_ms': _percentile(histogram.buckets, calls, 99),
+            'latency_buckets': dict(
+                zip([str(bound) for bound in LATENCY_BOUNDS_MS] + ['inf'],
+                    histogram.buckets)),
+            'per_call': dict((name, round(
+                float(histogram.counters[name]) / calls, 2))
+                for name in COUNTERS),
+        }
+        sized = histogram.counters['sized_responses']
+        if sized:
+            methods[method]['per_call']['response_bytes'] = round(
+                float(histogram.counters['response_bytes']) / sized, 2)
+
+    return {'window_seconds': WINDOW_SECONDS,
+            'latency_bounds_ms': list(LATENCY_BOUNDS_MS),
+            'methods': methods,
+            'cache': cache.stats(),
+            'hints': hints.stats()}
+
+
+install()
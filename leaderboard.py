@@ -0,0 +1,84 @@
+"""leaderboard.py - Paged user rankings. Each Score stores the player's name
+and a single rank so a page is one indexed query with no User gets. Pages
+within the top TOP_K entries are cached in memcache against a generation
+number that is bumped whenever a game ends."""
+
+import time
+
+from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
+
+from models import Score, ScoreForm, ScoreForms
+from utils import page_size
+
+TOP_K = 100
+
+GENERATION_KEY = 'leaderboard-generation'
+
+
+def generation():
+    """Returns the current leaderboard generation. If memcache lost it a new
+    one is started from the current time so it never goes backwards."""
+    current = memcache.get(GENERATION_KEY)
+    if current is None:
+        memcache.add(GENERATION_KEY, int(time.time()))
+        current = memcache.get(GENERATION_KEY)
+    return current
+
+
+def invalidate():
+    """Moves the leaderboard to a new generation so cached pages are no
+    longer used. Called after scores change."""
+    if memcache.incr(GENERATION_KEY) is None:
+        generation()
+
+
+def _parse_token(page_token):
+    """Page tokens are '<offset>:<urlsafe cursor>'"""
+    if not page_token:
+        return 0, None
+    try:
+        offset, _, cursor = page_token.partition(':')
+        return int(offset), Cursor(urlsafe=cursor)
+    except Exception:
+        raise ValueError('Invalid page token')
+
+
+def etag(limit=None, page_token=None, current_generation=None):
+    """Returns the ETag of a page of the rankings. It changes whenever the
+    leaderboard moves to a new generation."""
+    return '"r{}-{}-{}"'.format(current_generation or generation(),
+                                page_size(limit), page_token or '')
+
+
+def page(limit=None, page_token=None, current_generation=None):
+    """Returns a ScoreForms holding one page of the rankings"""
+    limit = page_size(limit)
+    offset, cursor = _parse_token(page_token)
+
+    cache_key = 'leaderboard-{}-{}-{}'.format(
+        current_generation or generation(), limit, page_token or '')
+    cacheable = offset < TOP_K
+    if cacheable:
+        cached = memcache.get(cache_key)
+        if cached is not None:
+            return _to_forms(*cached)
+
+    scores, next_cursor, more = Score.query().order(-Score.rank).fetch_page(
+        limit, start_cursor=cursor)
+
+    rows = [(form.player_name, form.wins, form.losses, form.ties)
+            for form in Score.to_forms(scores)]
+    next_token = '{}:{}'.format(offset + len(rows), next_cursor.urlsafe()) \
+        if more and next_cursor else None
+
+    if cacheable:
+        memcache.set(cache_key, (rows, next_token))
+    return _to_forms(rows, next_token)
+
+
+def _to_forms(rows, next_token):
+    return ScoreForms(items=[ScoreForm(player_name=name, wins=wins,
+                                       losses=losses, ties=ties)
+                             for name, wins, losses, ties in rows],
+                      next_page_token=next_token)
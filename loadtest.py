@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+"""loadtest.py - Plays full games against TicTacToeApi in-process, using the
+App Engine testbed stubs for the datastore, memcache and the task queue. For
+each endpoint it reports p50/p95/p99 latency, the RPCs made per call and the
+entity bytes written per call.
+
+Needs the App Engine Python SDK:
+
+    python loadtest.py --sdk ~/google-cloud-sdk/platform/google_appengine \\
+        --games 200 --freak-factor 3 --threads 4
+"""
+
+import argparse
+import collections
+import os
+import random
+import sys
+import threading
+import time
+import wsgiref.headers
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='Path to the App Engine SDK (or set '
+                             'APPENGINE_SDK)')
+    parser.add_argument('--games', type=int, default=100,
+                        help='Number of games to play')
+    parser.add_argument('--freak-factor', type=int, action='append',
+                        help='freak_factor for new games. Repeat to mix '
+                             'board sizes. Defaults to 1, 2, 3 and 12.')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Number of games played at the same time')
+    parser.add_argument('--players', type=int, default=20,
+                        help='Number of users to pick players from')
+    parser.add_argument('--polls', type=int, default=1,
+                        help='get_game calls by the waiting player after '
+                             'each move')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def setup_sdk(sdk):
+    """Puts the SDK and its bundled libraries on sys.path"""
+    if not sdk:
+        sys.exit('Pass --sdk or set APPENGINE_SDK to the App Engine SDK')
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+
+class Recorder(object):
+    """Collects latencies, RPC counts and bytes written per endpoint. RPCs
+    are attributed to whichever endpoint the calling thread is in."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = threading.local()
+        self.latencies = collections.defaultdict(list)
+        self.rpcs = collections.defaultdict(collections.Counter)
+        self.bytes_written = collections.Counter()
+
+    def rpc_hook(self, service, call, request, response, rpc=None):
+        endpoint = getattr(self.current, 'endpoint', None)
+        if endpoint is None:
+            return
+        written = 0
+        if service == 'datastore_v3' and call == 'Put':
+            written = sum(entity.ByteSize()
+                          for entity in request.entity_list())
+        with self.lock:
+            self.rpcs[endpoint]['{}.{}'.format(service, call)] += 1
+            self.bytes_written[endpoint] += written
+
+    def call(self, endpoint, method, request):
+        self.current.endpoint = endpoint
+        start = time.time()
+        try:
+            return method(request)
+        finally:
+            elapsed = time.time() - start
+            self.current.endpoint = None
+            with self.lock:
+                self.latencies[endpoint].append(elapsed)
+
+    def report(self):
+        print('{:<22} {:>6} {:>9} {:>9} {:>9} {:>11}'.format(
+            'endpoint', 'calls', 'p50 ms', 'p95 ms', 'p99 ms', 'bytes/call'))
+        for endpoint in sorted(self.latencies):
+            latencies = sorted(self.latencies[endpoint])
+            calls = len(latencies)
+            print('{:<22} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>11.0f}'.format(
+                endpoint, calls,
+                percentile(latencies, 50) * 1000,
+                percentile(latencies, 95) * 1000,
+                percentile(latencies, 99) * 1000,
+                float(self.bytes_written[endpoint]) / calls))
+
+        print('\nRPCs per call')
+        for endpoint in sorted(self.rpcs):
+            calls = len(self.latencies[endpoint])
+            print('  ' + endpoint)
+            for rpc, count in sorted(self.rpcs[endpoint].items()):
+                print('    {:<34} {:>8.2f}'.format(rpc,
+                                                   float(count) / calls))
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of an already sorted list"""
+    index = max(0, int(round(percent / 100.0 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def main():
+    args = parse_args()
+    setup_sdk(args.sdk)
+
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+    from protorpc import remote
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import api
+    from engine import Bitboard
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=os.path.dirname(
+        os.path.abspath(__file__)))
+    bed.init_app_identity_stub()
+
+    recorder = Recorder()
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'loadtest', recorder.rpc_hook)
+
+    def new_service():
+        service = api.TicTacToeApi()
+        service.initialize_request_state(remote.HttpRequestState(
+            http_method='GET', service_path='/_ah/spi',
+            headers=wsgiref.headers.Headers([])))
+        return service
+
+    def request(container, **fields):
+        return container.combined_message_class(**fields)
+
+    # A fresh datastore has no users to migrate, so signups are open
+    from models import Migration, USERS_MIGRATION
+    Migration(id=USERS_MIGRATION).put()
+
+    setup = new_service()
+    names = ['player{}'.format(index) for index in range(args.players)]
+    for name in names:
+        setup.create_user(request(api.CREATE_USER_REQUEST, user_name=name,
+                                  email=name + '@example.com'))
+
+    freak_factors = args.freak_factor or [1, 2, 3, 12]
+    rng = random.Random(args.seed)
+    games = [(rng.sample(names, 2), rng.choice(freak_factors),
+              rng.randint(0, 1 << 30)) for _ in range(args.games)]
+    queue = collections.deque(games)
+    queue_lock = threading.Lock()
+
+    def play(players, freak_factor, seed):
+        game_rng = random.Random(seed)
+        service = new_service()
+        form = recorder.call('new_game', service.new_game, request(
+            api.NEW_GAME_REQUEST, player_one_name=players[0],
+            player_two_name=players[1], freak_factor=freak_factor))
+        key = form.urlsafe_key
+        bitboard = Bitboard(form.rows, form.cols, form.winning_length)
+
+        while not form.game_over:
+            free = [(row, col) for row in range(form.rows)
+                    for col in range(form.cols)
+                    if bitboard.is_free(row, col)]
+            row, col = game_rng.choice(free)
+            mover = form.whos_turn
+            form = recorder.call('make_move', service.make_move, request(
+                api.MAKE_MOVE_REQUEST, urlsafe_game_key=key,
+                player_name=players[mover - 1], move_row=row, move_col=col))
+            bitboard.mark(mover, row, col)
+
+            for _ in range(args.polls):
+                recorder.call('get_game', service.get_game, request(
+                    api.GET_GAME_REQUEST, urlsafe_game_key=key))
+
+        recorder.call('game_history', service.game_history, request(
+            api.GAME_HISTORY_REQUEST, urlsafe_game_key=key))
+
+    def worker():
+        while True:
+            with queue_lock:
+                if not queue:
+                    return
+                game = queue.popleft()
+            play(*game)
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    for name in names[:5]:
+        recorder.call('get_user_games', setup.get_user_games, request(
+            api.USER_GAMES_REQUEST, user_name=name))
+    recorder.call('get_user_rankings', setup.get_user_rankings,
+                  request(api.PAGE_REQUEST))
+
+    print('Played {} games in {:.2f}s with {} thread(s)\n'.format(
+        args.games, elapsed, args.threads))
+    recorder.report()
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
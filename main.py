@@ -3,49 +3,73 @@
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
 
+import datetime
+import json
+import logging
+
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from api import TicTacToeApi
 
-from models import Game
+import archive
+import cache
+import instrumentation
+import leaderboard
+import reminders
+from models import ActiveGames, Game, Migration, MoveReceipt, Score, \
+    Tournament, User, USERS_MIGRATION
+
+BACKFILL_BATCH_SIZE = 100
+MIGRATE_BATCH_SIZE = 20
+EXPIRE_BATCH_SIZE = 500
+MOVE_RECEIPT_DAYS = 1
 
 
 class SendReminderEmail(webapp2.RequestHandler):
 
     @staticmethod
     def get():
-        """Send a reminder email to the user who's turn it is for
-        each game that is active. Called every hour using a cron job"""
-        app_id = app_identity.get_application_id()
-
-        # Get all in progress games
-        games = Game.query(Game.game_over == False)
-        for game in games:
-
-            # Get first player or second player based on whos turn
-            if game.whos_turn == 1:
-                user = game.player_one.get()
-            else:
-                user = game.player_two.get()
-
-            # If the user has an email send them a little reminder
-            if user.email is not None:
-                subject = 'Freaky TicTacToe Reminder'
-                body = 'Hello {}, it is currently your turn in the game [ {} ]. Please return to the game.'\
-                    .format(user.name, game.key.urlsafe())
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                               user.email,
-                               subject,
-                               body)
+        """Send a reminder email to each user who's turn it is in any
+        active game. Called every day using a cron job. The work is done in
+        task queue batches (see reminders.py)"""
+        reminders.start_run()
+
+
+class ReminderBatch(webapp2.RequestHandler):
+
+    def post(self):
+        """Queues reminders for one batch of active games"""
+        reminders.process_batch(self.request.get('run_id'),
+                                self.request.get('cursor') or None)
+
+
+class SendReminderDigest(webapp2.RequestHandler):
+
+    def post(self):
+        """Sends one user the reminder listing all of their games"""
+        reminders.send_digest(ndb.Key(urlsafe=self.request.get('user_key')))
 
 
 class IncrementActiveGames(webapp2.RequestHandler):
 
-    @staticmethod
-    def post():
+    def post(self):
         """This method which is called via the task queue
-        increments the number of active games in cache"""
-        TicTacToeApi.increment_active_games()
+        increments the number of active games by count (default 1)"""
+        TicTacToeApi.increment_active_games(
+            int(self.request.get('count') or 1))
+
+
+class AddActiveGames(webapp2.RequestHandler):
+
+    def post(self):
+        """Adds newly created games to their players' ActiveGames. Queued
+        by create_games_batch and create_tournament before they write the
+        games, in case updating the index straight away fails."""
+        TicTacToeApi.add_active_games(
+            [ndb.Key(urlsafe=game_key)
+             for game_key in json.loads(self.request.get('games'))])
 
 
 class DecrementActiveGames(webapp2.RequestHandler):
@@ -53,12 +77,279 @@ class DecrementActiveGames(webapp2.RequestHandler):
     @staticmethod
     def post():
         """This method which is called via the task queue
-        decrements the number of active games in cache"""
+        decrements the number of active games"""
         TicTacToeApi.decrement_active_games()
 
 
+class ReconcileActiveGames(webapp2.RequestHandler):
+
+    @staticmethod
+    def get():
+        """Rebuild the active games counter from the datastore.
+        Called every day using a cron job"""
+        TicTacToeApi.reconcile_active_games()
+
+
+class ExpireMoveReceipts(webapp2.RequestHandler):
+
+    def get(self):
+        """Deletes move receipts older than MOVE_RECEIPT_DAYS. Called every
+        day using a cron job. Handles one batch then queues itself for the
+        next one."""
+        cutoff = datetime.datetime.utcnow() - \
+            datetime.timedelta(days=MOVE_RECEIPT_DAYS)
+        keys = MoveReceipt.query(MoveReceipt.created < cutoff)\
+            .fetch(EXPIRE_BATCH_SIZE, keys_only=True)
+        ndb.delete_multi(keys)
+
+        if len(keys) == EXPIRE_BATCH_SIZE:
+            taskqueue.add(url='/crons/expire_move_receipts', method='GET')
+
+
+class BackfillScores(webapp2.RequestHandler):
+
+    def post(self):
+        """Re-puts Scores saved before they stored the player name and rank
+        so they show up in the rankings. Handles one batch then queues
+        itself for the next one."""
+        cursor = self.request.get('cursor')
+        scores, next_cursor, more = Score.query().fetch_page(
+            BACKFILL_BATCH_SIZE,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+
+        names = User.names_for([score.key.parent() for score in scores])
+        for score in scores:
+            if score.player_name is None:
+                score.player_name = names.get(score.key.parent())
+        ndb.put_multi(scores)
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_scores',
+                          params={'cursor': next_cursor.urlsafe()})
+        else:
+            leaderboard.invalidate()
+
+
+class MigrateUsers(webapp2.RequestHandler):
+
+    def post(self):
+        """Moves Users created before they were keyed by name onto their
+        name-based key, along with their Score and every Game that refers to
+        them. Handles one batch then queues itself for the next one."""
+        cursor = self.request.get('cursor')
+        users, next_cursor, more = User.query().fetch_page(
+            MIGRATE_BATCH_SIZE,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+
+        for user in users:
+            if not User.normalize(user.name):
+                logging.warning('Not migrating user %s, it has no name',
+                                user.key)
+            elif user.key != User.key_for(user.name):
+                migrate_user(user)
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_users',
+                          params={'cursor': next_cursor.urlsafe()})
+        else:
+            # Lets create_user take signups and stops name lookups falling
+            # back to a query
+            Migration(id=USERS_MIGRATION).put()
+
+
+def migrate_user(user):
+    """Re-keys a single User. The name-based key is claimed first, then the
+    user's games and tournaments are pointed at it, and the old entities are
+    deleted last. Safe to run again if it fails part way."""
+    new_key = User.key_for(user.name)
+    if not _claim_user(user, new_key):
+        logging.warning('Not migrating user %s, the name is already taken',
+                        user.key)
+        return
+
+    # Doing this again is harmless, so a retry picks up where a failed
+    # attempt stopped. Each one is re-read in its own transaction so a move
+    # made meanwhile isn't overwritten.
+    game_keys = Game.query(ndb.OR(Game.player_one == user.key,
+                                  Game.player_two == user.key))\
+        .fetch(keys_only=True)
+    games = [game for game in [_repoint_game(key, user.key, new_key)
+                               for key in game_keys] if game is not None]
+    for game in games:
+        cache.invalidate(game.key)
+
+    for key in Tournament.query(Tournament.players == user.key)\
+            .fetch(keys_only=True):
+        _repoint_tournament(key, user.key, new_key)
+
+    _finish_migration(user.key, new_key, games)
+
+
+@ndb.transactional
+def _claim_user(user, new_key):
+    """Creates the User on its name-based key along with an empty Score and
+    ActiveGames. Returns False if someone else already has the name."""
+    existing = new_key.get()
+    if existing is not None:
+        # Claimed by an earlier attempt at this migration
+        return existing.migrated_from == user.key
+
+    ndb.put_multi([
+        User(key=new_key, name=user.name, email=user.email,
+             migrated_from=user.key),
+        Score(key=Score.key_for(new_key), wins=0, losses=0, ties=0,
+              player_name=user.name),
+        ActiveGames(key=ActiveGames.key_for(new_key))])
+    return True
+
+
+@ndb.transactional
+def _repoint_game(game_key, old_key, new_key):
+    """Replaces old_key with new_key in a game's players and winner.
+    Returns the game or None if it no longer exists."""
+    game = game_key.get()
+    if game is None:
+        return None
+
+    changed = False
+    for prop in ('player_one', 'player_two', 'winner'):
+        if getattr(game, prop) == old_key:
+            setattr(game, prop, new_key)
+            changed = True
+    if changed:
+        game.put()
+    return game
+
+
+@ndb.transactional
+def _repoint_tournament(tournament_key, old_key, new_key):
+    """Replaces old_key with new_key in a tournament's players"""
+    tournament = tournament_key.get()
+    if tournament is not None and old_key in tournament.players:
+        tournament.players = [new_key if key == old_key else key
+                              for key in tournament.players]
+        tournament.put()
+
+
+@ndb.transactional(xg=True)
+def _finish_migration(old_key, new_key, games):
+    """Adds the old Score onto the new one, which has only counted games
+    that ended since they were re-pointed. Fills in the new ActiveGames and
+    deletes the old entities."""
+    user = old_key.get()
+    if user is None:
+        return
+
+    old_score = Score.get_for_users([old_key])[0]
+    new_score = Score.key_for(new_key).get() or \
+        Score(key=Score.key_for(new_key), wins=0, losses=0, ties=0,
+              player_name=user.name)
+    active = ActiveGames.key_for(new_key).get() or \
+        ActiveGames(key=ActiveGames.key_for(new_key))
+    for game in games:
+        if not game.game_over:
+            active.add(game.key)
+
+    old_keys = [old_key, ActiveGames.key_for(old_key)]
+    if old_score is not None:
+        new_score.wins += old_score.wins
+        new_score.losses += old_score.losses
+        new_score.ties += old_score.ties
+        old_keys.append(old_score.key)
+
+    ndb.put_multi([new_score, active])
+    ndb.delete_multi(old_keys)
+
+
+class BackfillActiveGames(webapp2.RequestHandler):
+
+    def post(self):
+        """Builds an ActiveGames for every User that doesn't have one yet.
+        Handles one batch then queues itself for the next one."""
+        cursor = self.request.get('cursor')
+        users, next_cursor, more = User.query().fetch_page(
+            BACKFILL_BATCH_SIZE, keys_only=True,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+
+        existing = ndb.get_multi([ActiveGames.key_for(key) for key in users])
+        for user_key, active in zip(users, existing):
+            if active is None:
+                _insert_active_games(
+                    TicTacToeApi._build_active_games(user_key))
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_active_games',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+@ndb.transactional
+def _insert_active_games(active):
+    if active.key.get() is None:
+        active.put()
+
+
+class ArchiveGames(webapp2.RequestHandler):
+
+    def get(self):
+        """Moves games that ended a while ago into the archive. Called every
+        day using a cron job. Handles one batch then queues the next one
+        (see archive.py)."""
+        archive.archive_batch()
+
+    def post(self):
+        """Handles a batch queued by the previous one"""
+        archive.archive_batch(self.request.get('cursor') or None)
+
+
+class BackfillGameEnded(webapp2.RequestHandler):
+
+    def post(self):
+        """Sets ended to now on finished games from before it existed, so
+        they are archived like the others. Handles one batch then queues
+        itself for the next one."""
+        cursor = self.request.get('cursor')
+        query = Game.query(Game.game_over == True)
+        games, next_cursor, more = query.fetch_page(
+            BACKFILL_BATCH_SIZE,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+
+        now = datetime.datetime.utcnow()
+        missing = [game for game in games if game.ended is None]
+        for game in missing:
+            game.ended = now
+        ndb.put_multi(missing)
+        for game in missing:
+            cache.invalidate(game.key)
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_game_ended',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class AdminStats(webapp2.RequestHandler):
+
+    def get(self):
+        """Returns this instance's per-endpoint latency histograms, RPC
+        counts and cache hit rates as JSON"""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(instrumentation.stats(),
+                                       sort_keys=True))
+
+
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
+    ('/tasks/reminder_batch', ReminderBatch),
+    ('/tasks/send_reminder', SendReminderDigest),
+    ('/crons/reconcile_active_games', ReconcileActiveGames),
+    ('/crons/expire_move_receipts', ExpireMoveReceipts),
+    ('/crons/archive_games', ArchiveGames),
+    ('/tasks/archive_games', ArchiveGames),
+    ('/tasks/backfill_game_ended', BackfillGameEnded),
     ('/tasks/increment_active_games', IncrementActiveGames),
-    ('/tasks/decrement_active_games', DecrementActiveGames)
+    ('/tasks/add_active_games', AddActiveGames),
+    ('/tasks/decrement_active_games', DecrementActiveGames),
+    ('/tasks/backfill_scores', BackfillScores),
+    ('/tasks/migrate_users', MigrateUsers),
+    ('/tasks/backfill_active_games', BackfillActiveGames),
+    ('/admin/stats', AdminStats)
 ], debug=True)
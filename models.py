@@ -4,14 +4,82 @@ classes they can include methods (such as 'to_form' and 'new_game')."""
 
 from protorpc import messages
 from google.appengine.ext import ndb
+import datetime
 import json
 
+import cache
+import movelog
+import solver
+from engine import Bitboard, DRAW, ONGOING, WON, dimensions
+
+
+RANK_PART_MAX = (1 << 20) - 1
+
+# Migration id recorded once /tasks/migrate_users has finished
+USERS_MIGRATION = 'users'
+_users_migrated = False
+
+# The User the computer plays as. It has no Score or ActiveGames.
+COMPUTER_NAME = 'Computer'
+
+# Search budget for a computer reply worked out inside a move transaction.
+# Replies are normally planned before it, see plan_computer_replies.
+TRANSACTION_BUDGET_SECONDS = 0.05
+
+# Ways GameForm.board can be written. 'delta' is only used by game_history.
+BOARD_FORMATS = ('json', 'flat', 'packed', 'delta')
+
 
 class User(ndb.Model):
-    """User profile"""
+    """User profile. Keyed by the normalized name so names are unique and a
+    lookup is a strongly consistent get."""
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
 
+    # The User's key before it was keyed by name, set by /tasks/migrate_users
+    migrated_from = ndb.KeyProperty(kind='User', indexed=False)
+
+    @staticmethod
+    def normalize(name):
+        """Returns the form of a name used as the User's key id"""
+        return (name or '').strip().lower()
+
+    @classmethod
+    def key_for(cls, name):
+        """Returns the key of the User with the given name"""
+        return ndb.Key(cls, cls.normalize(name))
+
+    @classmethod
+    def get_by_name(cls, name):
+        """Returns the User with the given name or None. Users created
+        before they were keyed by name are found with a query until
+        /tasks/migrate_users has finished."""
+        if not cls.normalize(name):
+            return None
+        user = cache.get(cls.key_for(name))
+        if user is not None or cls.migration_done():
+            return user
+        return cls.query(cls.name == name).get()
+
+    @staticmethod
+    def migration_done():
+        """Check if /tasks/migrate_users has finished. Once it has, the
+        instance remembers so the Migration isn't read again."""
+        global _users_migrated
+        if not _users_migrated:
+            _users_migrated = ndb.Key(Migration, USERS_MIGRATION).get() \
+                is not None
+        return _users_migrated
+
+    @classmethod
+    def names_for(cls, user_keys):
+        """Returns a dict of User key to name for every key given, fetched
+        with a single get_multi"""
+        keys = list(set(key for key in user_keys if key is not None))
+        return dict((key, user.name)
+                    for key, user in zip(keys, ndb.get_multi(keys))
+                    if user is not None)
+
 
 class Game(ndb.Model):
     """Game object"""
@@ -25,41 +93,34 @@ class Game(ndb.Model):
     winning_length = ndb.IntegerProperty(required=True)
     whos_turn = ndb.IntegerProperty(required=True, default=1)
     board = ndb.JsonProperty(required=True)
+    player_one_bits = ndb.IntegerProperty(indexed=False)
+    player_two_bits = ndb.IntegerProperty(indexed=False)
     game_over = ndb.BooleanProperty(required=True, default=False)
+    move_log = ndb.BlobProperty()
+
+    # Bumped by every move log entry so clients can tell the game changed
+    version = ndb.IntegerProperty(indexed=False, default=0)
+
+    # When the game was won, drawn or cancelled. Used to find games to
+    # archive.
+    ended = ndb.DateTimeProperty()
 
     @classmethod
     def new_game(cls, player_one, player_two, freak_factor):
         """Creates and returns a new game"""
+        game = cls.build(player_one, player_two, freak_factor)
+        game.put()
+        return game
 
-        # Change number of rows and cols based on freak_factor
-        if freak_factor % 3 == 0:
-            rows = 5
-            cols = 5
-        elif freak_factor % 2 == 0:
-            rows = 4
-            cols = 4
-        else:
-            rows = 3
-            cols = 3
-
-        # Freak factor >= 10 means take the smallest axis and make that
-        # the winning length
-        if freak_factor >= 10:
-            winning_length = min(rows, cols)
-        else:
-            winning_length = 3
-
-        # Build a board representation
-        board = []
-        for i in range(0, rows):
-
-            row = []
-            for j in range(0, cols):
-                row.append(0)
+    @classmethod
+    def build(cls, player_one, player_two, freak_factor, key=None):
+        """Returns a new game without putting it"""
 
-            board.append(row)
+        rows, cols, winning_length = dimensions(freak_factor)
+        bitboard = Bitboard(rows, cols, winning_length)
 
-        game = Game(player_one=player_one,
+        game = Game(key=key,
+                    player_one=player_one,
                     player_two=player_two,
                     winner=None,
                     freak_factor=freak_factor,
@@ -67,169 +128,298 @@ class Game(ndb.Model):
                     cols=cols,
                     winning_length=winning_length,
                     whos_turn=1,
-                    board=board,
+                    board=bitboard.to_board(),
+                    player_one_bits=bitboard.player_one,
+                    player_two_bits=bitboard.player_two,
                     game_over=False)
-        game.put()
+        game.record(movelog.CREATED)
         return game
 
     def move(self, row, col):
-        """This method handles a move for the player who's turn it is"""
-
-        board = self.board
-
-        if row + 1 > len(board) or col + 1 > len(board[0]):
-            raise ValueError(
-                "You can not move here. That's not even a spot on the board!")
-
-        if board[row][col] != 0:
-            raise ValueError(
-                "You can not move here. This space is already taken!")
+        """This method handles a move for the player who's turn it is.
+        Nothing is put. Returns any other entities changed by the move
+        (the Scores when the game ends) so they can be put with the game."""
 
-        # Mark the move on the board
-        board[row][col] = self.whos_turn
-        self.board = board
+        bitboard = self.get_bitboard()
+        outcome = bitboard.play(self.whos_turn, row, col)
+        self.set_bitboard(bitboard)
 
-        if self.check_did_win(self.whos_turn, row, col):
+        if outcome == WON:
+            self.record(movelog.WON, row, col)
             self.winner = self.player_one \
                 if self.whos_turn == 1 else self.player_two
             if self.whos_turn == 1:
-                self.end_game(self.player_one, self.player_two)
+                return self.end_game(self.player_one, self.player_two)
             else:
-                self.end_game(self.player_two, self.player_one)
-            return
+                return self.end_game(self.player_two, self.player_one)
 
-        if self.check_is_draw():
-            self.end_game()
-            return
+        if outcome == DRAW:
+            self.record(movelog.DRAW, row, col)
+            return self.end_game()
+
+        self.record(movelog.MOVE_ACCEPTED, row, col)
 
         # Player move is done set it to the next player's turn
         if self.whos_turn == 1:
             self.whos_turn = 2
         else:
             self.whos_turn = 1
-
-    def check_is_draw(self):
-        """Check if the game is a draw"""
-
-        # If any space is unmarked the game is not a draw
-        for row in self.board:
-            for col in row:
-                if col != 1 and col != 2:
-                    return False
-        return True
-
-    def check_did_win(self, last_move_user, last_move_row, last_move_col):
-        """Check if a user has won the game"""
-
-        # Check column win
-        in_col = 0
-
-        for col in range(0, self.cols):
-
-            if self.board[last_move_row][col] != last_move_user:
-                in_col = 0
+        return []
+
+    def is_computer_turn(self):
+        """Check if it is the computer's turn"""
+        player = self.player_one if self.whos_turn == 1 else self.player_two
+        return player == User.key_for(COMPUTER_NAME)
+
+    def computer_move(self, replies=None):
+        """Makes the computer's move. Like move, nothing is put and the
+        other entities changed are returned. replies comes from
+        plan_computer_replies. A position it doesn't cover only gets a
+        TRANSACTION_BUDGET_SECONDS search."""
+        bitboard = self.get_bitboard()
+        move = (replies or {}).get((bitboard.player_one, bitboard.player_two))
+        if move is None:
+            move = solver.choose_move(bitboard, self.whos_turn,
+                                      TRANSACTION_BUDGET_SECONDS)
+        return self.move(*move)
+
+    def plan_computer_replies(self, moves):
+        """Works out the computer's replies to a list of (row, col) moves,
+        so the full search can run before the move transaction instead of
+        in it. Returns a dict of (player_one_bits, player_two_bits) to the
+        (row, col) the computer plays there. The game isn't changed."""
+        replies = {}
+        computer = User.key_for(COMPUTER_NAME)
+        players = {1: self.player_one, 2: self.player_two}
+        if self.game_over or computer not in players.values():
+            return replies
+
+        bitboard = self.get_bitboard()
+        whos_turn = self.whos_turn
+        moves = list(moves)
+        while True:
+            if players[whos_turn] == computer:
+                row, col = solver.choose_move(bitboard, whos_turn)
+                replies[(bitboard.player_one, bitboard.player_two)] = \
+                    (row, col)
+            elif moves:
+                row, col = moves.pop(0)
             else:
-                in_col += 1
-
-            if in_col == self.winning_length:
-                return True
-
-            # Impossible to create line on this row
-            if in_col + (self.cols - col) < self.winning_length:
                 break
 
-        # Check row win
-        in_row = 0
-        for row in xrange(0, self.rows):
-
-            if self.board[row][last_move_col] != last_move_user:
-                in_row = 0
-            else:
-                in_row += 1
-
-            if in_row == self.winning_length:
-                return True
-
-            # Impossible to create line in this column
-            if in_row + (self.rows - row) < self.winning_length:
+            try:
+                if bitboard.play(whos_turn, row, col) != ONGOING:
+                    break
+            except ValueError:
                 break
+            whos_turn = 2 if whos_turn == 1 else 1
+        return replies
+
+    def update_active_games(self):
+        """Adds a new game to both players' ActiveGames or removes a
+        finished one. Only call it then, not on every move, so a move's
+        transaction doesn't lock the players' entity groups. Returns the
+        ones that changed so they can be put along with the game. Users
+        without an ActiveGames are skipped, see get_user_games."""
+        changed = []
+        for active in ndb.get_multi([
+                ActiveGames.key_for(key)
+                for key in set([self.player_one, self.player_two])]):
+            if active is None:
+                continue
+            if active.remove(self.key) if self.game_over \
+                    else active.add(self.key):
+                changed.append(active)
+        return changed
+
+    def player_to_move(self):
+        """Returns the key of the User whose turn it is"""
+        return self.player_one if self.whos_turn == 1 else self.player_two
+
+    def is_turn(self, player_name):
+        """Check if it is the named player's turn"""
+        player = self.player_one if self.whos_turn == 1 else self.player_two
+        if player == User.key_for(player_name):
+            return True
+        return player.get().name == player_name
+
+    def get_bitboard(self):
+        """Returns the Bitboard for this game. Games stored before the
+        bitmask properties existed are converted from their JSON board."""
+        if self.player_one_bits is None or self.player_two_bits is None:
+            return Bitboard.from_board(self.board, self.winning_length)
+
+        return Bitboard(self.rows, self.cols, self.winning_length,
+                        self.player_one_bits, self.player_two_bits)
+
+    def set_bitboard(self, bitboard):
+        """Stores the bitmasks of a Bitboard on this game. The JSON board is
+        rebuilt from them when the game is put."""
+        self.player_one_bits = bitboard.player_one
+        self.player_two_bits = bitboard.player_two
 
-        # Check left diag win
-        diff = abs(last_move_col - last_move_row)
-        in_left_diag = 0
-        for row in xrange(0, self.rows):
-
-            col = diff + row
-            if col < 0 or col >= self.cols:
-                pass
-            elif self.board[row][col] == last_move_user:
-                in_left_diag += 1
-
-                if in_left_diag == self.winning_length:
-                    return True
-            else:
-                in_left_diag = 0
-
-        # Check right diag win
-        in_right_diag = 0
-
-        for row in xrange(0, self.rows):
-
-            col = self.cols - (diff + row)
-            if col < 0 or col >= self.cols:
-                pass
-            elif self.board[row][col] == last_move_user:
-                in_right_diag += 1
-
-                if in_right_diag == self.winning_length:
-                    return True
+    def check_is_draw(self):
+        """Check if the game is a draw"""
+        return self.get_bitboard().is_full()
 
-            else:
-                in_right_diag = 0
+    def check_did_win(self, last_move_user, last_move_row, last_move_col):
+        """Check if a user has won the game with a line through their last
+        move"""
+        return self.get_bitboard().wins_through(
+            last_move_user, last_move_row, last_move_col)
+
+    def record(self, message_id, row=movelog.NO_CELL, col=movelog.NO_CELL):
+        """Appends an entry for the player who's turn it is to the move
+        log"""
+        self.move_log = movelog.append(self.move_log, row, col,
+                                       self.whos_turn, message_id)
+        self.version = (self.version or 0) + 1
+
+    def load_move_log(self):
+        """Games created before the move log existed get one built from
+        their GameHistory"""
+        if self.move_log is None:
+            history = GameHistory.query(ancestor=self.key).get()
+            self.move_log = history.to_move_log() if history else b''
+
+    def last_message(self, player_name=''):
+        """Returns the message for the most recent move log entry"""
+        return movelog.message(movelog.last(self.move_log)[3], player_name)
+
+    def replay(self):
+        """Rebuilds the state of the game after each move log entry.
+        Returns a list of (Game, message, move) tuples and the player names
+        to pass to to_form. move is the (row, col) marked by the entry or
+        None. The Games are never put."""
+        names = User.names_for([self.player_one, self.player_two])
+        players = {1: names[self.player_one], 2: names[self.player_two]}
+        bitboard = Bitboard(self.rows, self.cols, self.winning_length)
+        states = []
+        winner = None
+        game_over = False
+
+        entries = movelog.entries(self.move_log)
+        for version, (row, col, player, message_id) in enumerate(entries, 1):
+            if row != movelog.NO_CELL:
+                bitboard.mark(player, row, col)
+
+            whos_turn = player
+            if message_id == movelog.MOVE_ACCEPTED:
+                whos_turn = 2 if player == 1 else 1
+            elif message_id == movelog.WON:
+                winner = self.player_one if player == 1 else self.player_two
+                game_over = True
+            elif message_id in (movelog.DRAW, movelog.CANCELLED):
+                game_over = True
+
+            state = Game(key=self.key,
+                         player_one=self.player_one,
+                         player_two=self.player_two,
+                         winner=winner,
+                         freak_factor=self.freak_factor,
+                         rows=self.rows,
+                         cols=self.cols,
+                         winning_length=self.winning_length,
+                         whos_turn=whos_turn,
+                         player_one_bits=bitboard.player_one,
+                         player_two_bits=bitboard.player_two,
+                         game_over=game_over,
+                         version=version)
+            move = (row, col) if row != movelog.NO_CELL else None
+            states.append((state,
+                           movelog.message(message_id, players[player]),
+                           move))
+
+        return states, names
+
+    def _pre_put_hook(self):
+        """Keep the JSON board in step with the bitmasks"""
+        if self.player_one_bits is not None and \
+                self.player_two_bits is not None:
+            self.board = self.get_bitboard().to_board()
 
-        return False
+    @classmethod
+    def summary_query(cls, user_key, player):
+        """Returns a projection query over the active games where the user
+        is player 1 or 2. Only the other player and whos_turn are loaded, so
+        the board is never read or decoded."""
+        if player == 1:
+            return cls.query(cls.player_one == user_key,
+                             cls.game_over == False,
+                             projection=[cls.player_two, cls.whos_turn])\
+                .order(cls.key)
+        return cls.query(cls.player_two == user_key,
+                         cls.game_over == False,
+                         projection=[cls.player_one, cls.whos_turn])\
+            .order(cls.key)
 
-    def to_form(self, message=""):
-        """Returns a GameForm representation of the Game"""
+    @classmethod
+    def to_forms(cls, games):
+        """Returns a GameForm for each Game. The players of every game are
+        fetched together with a single get_multi."""
+        games = list(games)
+        names = User.names_for([key for game in games
+                                for key in (game.player_one,
+                                            game.player_two,
+                                            game.winner)])
+        return [game.to_form(names=names) for game in games]
+
+    def to_form(self, message="", names=None, board_format=None):
+        """Returns a GameForm representation of the Game.
+        names is a dict of User key to name, looked up if not given.
+        board_format is one of BOARD_FORMATS and defaults to 'json'."""
+        if names is None:
+            names = User.names_for([self.player_one, self.player_two,
+                                    self.winner])
 
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.player_one_name = self.player_one.get().name
-        form.player_two_name = self.player_two.get().name
-        form.winner_name = self.winner.get().name \
+        form.player_one_name = names[self.player_one]
+        form.player_two_name = names[self.player_two]
+        form.winner_name = names[self.winner] \
             if self.winner is not None else ""
         form.freak_factor = self.freak_factor
         form.rows = self.rows
         form.cols = self.cols
         form.winning_length = self.winning_length
         form.whos_turn = self.whos_turn
-        form.board = json.dumps(self.board)
+        bitboard = self.get_bitboard()
+        if board_format == 'flat':
+            form.board = bitboard.to_flat()
+        elif board_format == 'packed':
+            form.board = bitboard.to_packed()
+        elif board_format == 'delta':
+            form.board = ''
+        else:
+            form.board = json.dumps(bitboard.to_board())
+        form.board_format = board_format or 'json'
         form.game_over = self.game_over
         form.message = message
+        form.version = self.version
         return form
 
     def end_game(self, winner=None, loser=None):
         """Ends the game and records the scores
-        If winner is None then the game is a tie"""
+        If winner is None then the game is a tie.
+        Returns the Scores, which need to be put along with the game"""
         self.game_over = True
         self.winner = winner
+        self.ended = datetime.datetime.utcnow()
 
+        # The computer has no Score
         if winner is not None:
-            winner_score = Score.query(ancestor=winner).get()
-            loser_score = Score.query(ancestor=loser).get()
-            winner_score.wins += 1
-            loser_score.losses += 1
-            winner_score.put()
-            loser_score.put()
+            winner_score, loser_score = Score.get_for_users([winner, loser])
+            if winner_score:
+                winner_score.wins += 1
+            if loser_score:
+                loser_score.losses += 1
+            scores = [winner_score, loser_score]
         else:
-            player_one_score = Score.query(ancestor=self.player_one).get()
-            player_two_score = Score.query(ancestor=self.player_two).get()
-            player_one_score.ties += 1
-            player_two_score.ties += 1
-            player_one_score.put()
-            player_two_score.put()
-
-        self.put()
+            scores = Score.get_for_users([self.player_one, self.player_two])
+            for score in scores:
+                if score:
+                    score.ties += 1
+        return [score for score in scores if score is not None]
 
 
 class Score(ndb.Model):
@@ -238,56 +428,357 @@ class Score(ndb.Model):
     wins = ndb.IntegerProperty(required=True)
     losses = ndb.IntegerProperty(required=True)
     ties = ndb.IntegerProperty(required=True)
+    player_name = ndb.StringProperty(indexed=False)
+
+    # Single sort key for the rankings: wins descending, then ties
+    # descending, then losses ascending. Each part gets 20 bits.
+    rank = ndb.ComputedProperty(
+        lambda self: (min(self.wins, RANK_PART_MAX) << 40) |
+                     (min(self.ties, RANK_PART_MAX) << 20) |
+                     (RANK_PART_MAX - min(self.losses, RANK_PART_MAX)))
 
-    def to_form(self):
+    @classmethod
+    def key_for(cls, user_key):
+        """Returns the key of a User's Score"""
+        return ndb.Key(cls, 'score', parent=user_key)
 
-        player_name = self.key.parent().get().name
-        return ScoreForm(player_name=player_name, wins=self.wins,
-                         losses=self.losses, ties=self.ties)
+    @classmethod
+    def get_for_users(cls, user_keys):
+        """Returns the Score for each User key with a single get_multi.
+        Scores created before they had a fixed id are found with an
+        ancestor query."""
+        scores = ndb.get_multi([cls.key_for(key) for key in user_keys])
+        return [score or cls.query(ancestor=key).get()
+                for score, key in zip(scores, user_keys)]
+
+    @classmethod
+    def to_forms(cls, scores):
+        """Returns a ScoreForm for each Score. The Users are fetched
+        together with a single get_multi."""
+        scores = list(scores)
+        names = User.names_for([score.key.parent() for score in scores
+                                if score.player_name is None])
+        return [score.to_form(names) for score in scores]
+
+    def to_form(self, names=None):
+        """Returns a ScoreForm representation of the Score.
+        names is a dict of User key to name, only needed for Scores saved
+        before they stored the player's name."""
+        if self.player_name is not None:
+            player_name = self.player_name
+        elif names is not None:
+            player_name = names[self.key.parent()]
+        else:
+            player_name = self.key.parent().get().name
+
+        return ScoreForm(player_name=player_name,
+                         wins=self.wins, losses=self.losses, ties=self.ties)
+
+
+class ActiveGames(ndb.Model):
+    """Index of a User's active games. A child of the User with a fixed id
+    so it can be read with a key get and updated in the same transaction as
+    a game that starts or ends. It isn't touched by ordinary moves, so whose
+    turn it is comes from the games themselves."""
+    games = ndb.KeyProperty(kind='Game', repeated=True, indexed=False)
+
+    # No longer kept up to date, whose turn it is changes with every move
+    my_turn = ndb.KeyProperty(kind='Game', repeated=True, indexed=False)
+
+    @classmethod
+    def key_for(cls, user_key):
+        """Returns the key of a User's ActiveGames"""
+        return ndb.Key(cls, 'active', parent=user_key)
+
+    def add(self, game_key):
+        """Adds a game. Returns whether anything changed."""
+        if game_key in self.games:
+            return False
+        self.games.append(game_key)
+        return True
+
+    def remove(self, game_key):
+        """Removes a game. Returns whether anything changed."""
+        changed = False
+        if game_key in self.games:
+            self.games.remove(game_key)
+            changed = True
+        if game_key in self.my_turn:
+            self.my_turn.remove(game_key)
+            changed = True
+        return changed
 
 
 class GameHistory(ndb.Model):
 
-    """Game History Object"""
+    """Game History Object. Only games created before Game.move_log existed
+    have one."""
     history = ndb.PickleProperty(required=True, default=[])
     messages = ndb.PickleProperty(required=True, default=[])
 
+    def to_move_log(self):
+        """Converts the pickled Game snapshots into a move log by finding
+        the cell that changed between each pair of boards"""
+        log = b''
+        previous = None
+        for snapshot, text in zip(self.history, self.messages):
+            row = col = movelog.NO_CELL
+            player = snapshot.whos_turn
+            board = snapshot.board
+
+            if previous is not None:
+                for row_index, cells in enumerate(board):
+                    for col_index, cell in enumerate(cells):
+                        if cell != previous[row_index][col_index]:
+                            row, col, player = row_index, col_index, cell
+
+            message_id = movelog.message_id(text)
+
+            # Draws used to be reported with the winning message
+            if message_id == movelog.WON and snapshot.winner is None:
+                message_id = movelog.DRAW
+
+            log = movelog.append(log, row, col, player, message_id)
+            previous = board
+        return log
+
+
+class Tournament(ndb.Model):
+    """A round-robin tournament: one game between every pair of players"""
+    name = ndb.StringProperty(required=True)
+    freak_factor = ndb.IntegerProperty(required=True, indexed=False)
+    # Indexed so /tasks/migrate_users can find a User's tournaments
+    players = ndb.KeyProperty(kind='User', repeated=True)
+    games = ndb.KeyProperty(kind='Game', repeated=True, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+    def to_form(self, games):
+        """Returns a TournamentForm with the standings. games are the
+        tournament's Games, the players are fetched with a single
+        get_multi."""
+        names = User.names_for(self.players)
+        standings = dict((key, ScoreForm(player_name=names[key], wins=0,
+                                         losses=0, ties=0))
+                         for key in self.players)
+        finished = 0
+        for game in games:
+            if game is None or not game.game_over:
+                continue
+            finished += 1
+            if game.winner is not None:
+                loser = game.player_two if game.winner == game.player_one \
+                    else game.player_one
+                standings[game.winner].wins += 1
+                standings[loser].losses += 1
+            elif movelog.last(game.move_log)[3] == movelog.DRAW:
+                standings[game.player_one].ties += 1
+                standings[game.player_two].ties += 1
+
+        return TournamentForm(
+            urlsafe_key=self.key.urlsafe(),
+            name=self.name,
+            freak_factor=self.freak_factor,
+            game_keys=[key.urlsafe() for key in self.games],
+            games_finished=finished,
+            standings=sorted(standings.values(),
+                             key=lambda form: (-form.wins, -form.ties,
+                                               form.losses)))
+
+
+class MoveReceipt(ndb.Model):
+    """The result of a move made with a client request_id. A child of the
+    Game written in the move's transaction, so a retried request can be
+    answered without making the move again. Old ones are deleted by a
+    cron."""
+    message = ndb.StringProperty(required=True, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def key_for(cls, game_key, player_name, request_id):
+        """Returns the key of a player's receipt for a request_id"""
+        return ndb.Key(cls, u'{}:{}'.format(User.normalize(player_name),
+                                            request_id), parent=game_key)
+
+
+class SolvedPosition(ndb.Model):
+    """A solved position for get_hint, keyed by its board shape and
+    canonical key (see hints.py). move is a cell of the canonical
+    orientation. Entities with solved False were saved by older versions
+    and are ignored."""
+    move = ndb.IntegerProperty(required=True, indexed=False)
+    score = ndb.IntegerProperty(required=True, indexed=False)
+    solved = ndb.BooleanProperty(required=True, indexed=False)
+
+
+class ArchiveDay(ndb.Model):
+    """The archived games that ended on one day, keyed by the date as
+    YYYYMMDD. Its GameArchive children are numbered from 1 and parts is
+    the highest one."""
+    parts = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+
+class GameArchive(ndb.Model):
+    """Part of an ArchiveDay holding packed finished games (see
+    archive.py). players lists the urlsafe User keys the games refer to."""
+    players = ndb.StringProperty(repeated=True, indexed=False)
+    data = ndb.BlobProperty(required=True, default=b'', compressed=True)
+
+
+class ArchivedGame(ndb.Model):
+    """Points from an archived game's id to the GameArchive holding it and
+    the offset of its record in the part's data"""
+    part = ndb.KeyProperty(kind='GameArchive', required=True, indexed=False)
+    offset = ndb.IntegerProperty(indexed=False)
+
+    @classmethod
+    def key_for(cls, game_key):
+        """Returns the key of the pointer for a Game key"""
+        return ndb.Key(cls, game_key.id())
+
+
+class CounterShard(ndb.Model):
+    """One shard of a counter in counters.py"""
+    count = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+
+class Migration(ndb.Model):
+    """Marks a one-off data migration as finished. Keyed by its name."""
+    finished = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class ReminderRun(ndb.Model):
+    """Progress of a run of the reminder emails. Keyed by the run's date."""
+    cursor = ndb.StringProperty(indexed=False)
+    done = ndb.BooleanProperty(required=True, default=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
 
 class GameForm(messages.Message):
-    """GameForm for outbound game state information"""
+    """GameForm for outbound game state information. When not_modified is
+    set the client's copy is current and only urlsafe_key, version and
+    etag are filled in."""
+
+    urlsafe_key = messages.StringField(1, required=True)
+    player_one_name = messages.StringField(2)
+    player_two_name = messages.StringField(3)
+    freak_factor = messages.IntegerField(4)
+    rows = messages.IntegerField(5)
+    cols = messages.IntegerField(6)
+    winning_length = messages.IntegerField(7)
+    whos_turn = messages.IntegerField(8)
+    board = messages.StringField(9)
+    game_over = messages.BooleanField(10)
+    message = messages.StringField(11)
+    winner_name = messages.StringField(12, required=False)
+    version = messages.IntegerField(13)
+    etag = messages.StringField(14)
+    board_format = messages.StringField(15)
+    move_row = messages.IntegerField(16)
+    move_col = messages.IntegerField(17)
+    not_modified = messages.BooleanField(18)
+
+
+class GameUpdateForm(messages.Message):
+    """GameUpdateForm for the result of waiting for a game to change.
+    game is only set if the game has moved past the version waited on."""
+    modified = messages.BooleanField(1, required=True)
+    version = messages.IntegerField(2, required=True)
+    game = messages.MessageField(GameForm, 3)
+
 
+class GameSummaryForm(messages.Message):
+    """GameSummaryForm for outbound game information without the board"""
     urlsafe_key = messages.StringField(1, required=True)
     player_one_name = messages.StringField(2, required=True)
     player_two_name = messages.StringField(3, required=True)
-    freak_factor = messages.IntegerField(4, required=True)
-    rows = messages.IntegerField(5, required=True)
-    cols = messages.IntegerField(6, required=True)
-    winning_length = messages.IntegerField(7, required=True)
-    whos_turn = messages.IntegerField(8, required=True)
-    board = messages.StringField(9, required=True)
-    game_over = messages.BooleanField(10, required=True)
-    message = messages.StringField(11, required=True)
-    winner_name = messages.StringField(12, required=False)
+    whos_turn = messages.IntegerField(4, required=True)
+
+
+class HintForm(messages.Message):
+    """HintForm for a suggested move. outlook is 'win', 'loss' or 'draw'
+    when the position is solved and 'unclear' otherwise."""
+    move_row = messages.IntegerField(1, required=True)
+    move_col = messages.IntegerField(2, required=True)
+    outlook = messages.StringField(3, required=True)
+
+
+class GameCountsForm(messages.Message):
+    """GameCountsForm for a user's number of active games"""
+    active_games = messages.IntegerField(1, required=True)
+    my_turn = messages.IntegerField(2, required=True)
 
 
 class GameForms(messages.Message):
-    """Return multiple GameForms"""
+    """Return multiple GameForms, or GameSummaryForms. When not_modified is
+    set the client's copy is current and only etag is filled in."""
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
+    summaries = messages.MessageField(GameSummaryForm, 3, repeated=True)
+    etag = messages.StringField(4)
+    not_modified = messages.BooleanField(5)
 
 
 class NewGameForm(messages.Message):
     """Used to create a new game"""
 
     player_one_name = messages.StringField(1, required=True)
-    player_two_name = messages.StringField(2, required=True)
+    player_two_name = messages.StringField(2)
+    freak_factor = messages.IntegerField(3, default=1)
+    vs_computer = messages.BooleanField(4, default=False)
+
+
+class NewGamesForm(messages.Message):
+    """Used to create many games at once"""
+    games = messages.MessageField(NewGameForm, 1, repeated=True)
+
+
+class GameKeysForm(messages.Message):
+    """The urlsafe keys of newly created games, in the order requested"""
+    urlsafe_keys = messages.StringField(1, repeated=True)
+
+
+class NewTournamentForm(messages.Message):
+    """Used to create a round-robin tournament"""
+    name = messages.StringField(1, required=True)
+    player_names = messages.StringField(2, repeated=True)
     freak_factor = messages.IntegerField(3, default=1)
 
 
+class TournamentForm(messages.Message):
+    """TournamentForm for a tournament's games and standings"""
+    urlsafe_key = messages.StringField(1, required=True)
+    name = messages.StringField(2, required=True)
+    freak_factor = messages.IntegerField(3, required=True)
+    game_keys = messages.StringField(4, repeated=True)
+    games_finished = messages.IntegerField(5, required=True)
+    standings = messages.MessageField('ScoreForm', 6, repeated=True)
+
+
 class MakeMoveForm(messages.Message):
     """Used to make a move in an existing game"""
     player_name = messages.StringField(1, required=True)
     move_row = messages.IntegerField(2, required=True)
     move_col = messages.IntegerField(3, required=True)
+    request_id = messages.StringField(4)
+
+
+class MoveForm(messages.Message):
+    """One move of a MakeMovesForm"""
+    player_name = messages.StringField(1, required=True)
+    move_row = messages.IntegerField(2, required=True)
+    move_col = messages.IntegerField(3, required=True)
+
+
+class MakeMovesForm(messages.Message):
+    """Used to make a sequence of moves in an existing game"""
+    moves = messages.MessageField(MoveForm, 1, repeated=True)
+
+
+class MovesResultForm(messages.Message):
+    """The result of a MakeMovesForm. game.message explains why applying
+    stopped early, if it did."""
+    moves_made = messages.IntegerField(1, required=True)
+    game = messages.MessageField('GameForm', 2, required=True)
 
 
 class ScoreForm(messages.Message):
@@ -299,8 +790,12 @@ class ScoreForm(messages.Message):
 
 
 class ScoreForms(messages.Message):
-    """Return multiple ScoreForms"""
+    """Return multiple ScoreForms. When not_modified is set the client's
+    copy is current and only etag is filled in."""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
+    etag = messages.StringField(3)
+    not_modified = messages.BooleanField(4)
 
 
 class StringMessage(messages.Message):
@@ -0,0 +1,64 @@
+"""movelog.py - Compact, append-only record of everything that happened in a
+game. Each entry is packed into 4 bytes: row, col, player and a message id.
+Entries that don't place a mark (game created, game cancelled) use NO_CELL
+for the row and col."""
+
+import struct
+
+NO_CELL = 255
+
+CREATED = 0
+MOVE_ACCEPTED = 1
+WON = 2
+DRAW = 3
+CANCELLED = 4
+
+MESSAGES = {
+    CREATED: 'Game created successfully',
+    MOVE_ACCEPTED: 'Move accepted. Please wait for your next turn.',
+    WON: 'Thank you for playing. {} has won the game.',
+    DRAW: 'Thank you for playing. The game ended in a draw.',
+    CANCELLED: 'The game was cancelled successfuly.',
+}
+
+_ENTRY = struct.Struct('BBBB')
+ENTRY_SIZE = _ENTRY.size
+
+
+def pack(row, col, player, message_id):
+    """Returns a single packed entry"""
+    return _ENTRY.pack(row, col, player, message_id)
+
+
+def append(log, row, col, player, message_id):
+    """Returns the log with a new entry added to the end"""
+    return (log or b'') + pack(row, col, player, message_id)
+
+
+def entries(log):
+    """Returns the log as a list of (row, col, player, message_id) tuples"""
+    if not log:
+        return []
+    return [_ENTRY.unpack_from(log, offset)
+            for offset in range(0, len(log), ENTRY_SIZE)]
+
+
+def last(log):
+    """Returns the most recent entry"""
+    return _ENTRY.unpack_from(log, len(log) - ENTRY_SIZE)
+
+
+def message(message_id, player_name=''):
+    """Returns the text for a message id. player_name fills in the winner
+    for WON messages."""
+    return MESSAGES[message_id].format(player_name)
+
+
+def message_id(text):
+    """Returns the message id for text produced by message(). Used to
+    convert histories stored before the move log existed."""
+    for candidate, template in MESSAGES.items():
+        prefix, _, suffix = template.partition('{}')
+        if text.startswith(prefix) and text.endswith(suffix):
+            return candidate
+    return MOVE_ACCEPTED
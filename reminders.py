@@ -0,0 +1,105 @@
+"""reminders.py - Turn reminder emails.
+
+The cron starts a run that walks the active games in batches, one task per
+batch. A batch finds the users whose turn it is and queues a mail task for
+each of them. The task is named after the run and the user, so a user is
+only queued once no matter how many of their games are waiting. The mail
+task sends a single digest that lists all of them.
+
+After each batch the cursor is saved on the run's ReminderRun. A run that
+stops part way is picked up from there the next time it is started."""
+
+import datetime
+
+from google.appengine.api import app_identity, mail, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Game, ReminderRun
+
+BATCH_SIZE = 100
+
+BATCH_URL = '/tasks/reminder_batch'
+SEND_URL = '/tasks/send_reminder'
+
+
+def start_run(run_id=None):
+    """Starts today's run, or resumes it from its checkpoint if it was
+    started before and didn't finish"""
+    run_id = run_id or datetime.datetime.utcnow().strftime('%Y%m%d')
+    run = ReminderRun.get_or_insert(run_id)
+    if run.done:
+        return
+
+    taskqueue.add(url=BATCH_URL,
+                  params={'run_id': run_id, 'cursor': run.cursor or ''})
+
+
+def process_batch(run_id, cursor=None):
+    """Queues a reminder for every user whose turn it is in the next batch
+    of active games, then queues the batch after it"""
+    games, next_cursor, more = Game.query(
+        Game.game_over == False,
+        projection=[Game.player_one, Game.player_two, Game.whos_turn])\
+        .order(Game.key)\
+        .fetch_page(BATCH_SIZE,
+                    start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+
+    user_keys = list(set(game.player_one if game.whos_turn == 1
+                         else game.player_two for game in games))
+    tasks = [taskqueue.Task(url=SEND_URL,
+                            params={'user_key': user.key.urlsafe()},
+                            name='reminder-{}-{}'.format(run_id,
+                                                         user.key.urlsafe()))
+             for user in ndb.get_multi(user_keys)
+             if user is not None and user.email is not None]
+    _add_tasks(tasks)
+
+    more = bool(more and next_cursor)
+    ReminderRun(id=run_id,
+                cursor=next_cursor.urlsafe() if more else None,
+                done=not more).put()
+
+    if more:
+        taskqueue.add(url=BATCH_URL,
+                      params={'run_id': run_id,
+                              'cursor': next_cursor.urlsafe()})
+
+
+def _add_tasks(tasks):
+    """Adds tasks in groups of the most a single add allows. Tasks that
+    were already added by this run are skipped."""
+    queue = taskqueue.Queue()
+    for start in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        try:
+            queue.add(tasks[start:start + taskqueue.MAX_TASKS_PER_ADD])
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+
+def send_digest(user_key):
+    """Sends a user one email listing every game where it is their turn"""
+    user = user_key.get()
+    if user is None or user.email is None:
+        return
+
+    game_keys = Game.query(Game.game_over == False,
+                           Game.player_one == user_key,
+                           Game.whos_turn == 1).fetch(keys_only=True)
+    game_keys += Game.query(Game.game_over == False,
+                            Game.player_two == user_key,
+                            Game.whos_turn == 2).fetch(keys_only=True)
+    if not game_keys:
+        return
+
+    app_id = app_identity.get_application_id()
+    subject = 'Freaky TicTacToe Reminder'
+    body = 'Hello {}, it is currently your turn in the following games. ' \
+           'Please return to them.\n\n{}'\
+        .format(user.name, '\n'.join('[ {} ]'.format(key.urlsafe())
+                                     for key in game_keys))
+    mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
+                   user.email,
+                   subject,
+                   body)
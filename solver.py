@@ -0,0 +1,382 @@
+"""solver.py - The computer opponent. Picks moves with an alpha-beta search
+over the bitboards in engine.py. Like engine.py it doesn't depend on the App
+Engine runtime.
+
+Positions are looked up by a canonical key: the smallest encoding of the
+position over every rotation and reflection of the board, so symmetric
+positions share one transposition table entry. The search deepens one ply
+at a time until the position is solved or the time budget runs out, and
+plays the best move of the deepest search that finished.
+
+The first moves on 3x3 and 4x4 boards come from an opening book, built
+offline with 'python solver.py --build-book' and stored in
+opening_book.bin."""
+
+import os
+import struct
+import time
+
+from engine import NEW_GAME_SHAPES, popcount, win_masks
+
+# Scores at or above WIN_SCORE are proven wins. A win is worth more the
+# more cells are still empty, so the search prefers quicker wins.
+WIN_SCORE = 1000000
+
+DEFAULT_BUDGET_SECONDS = 0.5
+
+# The search checks the clock every this many nodes
+CLOCK_INTERVAL = 1024
+
+# Transposition tables are cleared once they hold this many positions
+MAX_TABLE_ENTRIES = 500000
+
+# Heuristic value of an open line holding n of a player's marks
+LINE_WEIGHTS = (0, 1, 8, 64, 512, 4096)
+
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+BOOK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'opening_book.bin')
+
+# Marks on the board up to which each shape's book has a move. 3x3 boards
+# are solved completely.
+BOOK_DEPTHS = {(3, 3, 3): 8, (4, 4, 3): 3, (4, 4, 4): 2}
+
+# Book budget per position, generous because it is spent offline
+BOOK_BUDGET_SECONDS = 5
+
+# rows, cols, winning_length, move, mover's marks, other player's marks
+_BOOK_RECORD = struct.Struct('<BBBBHH')
+
+_SYMMETRIES = {}
+_TABLES = {}
+_book = None
+
+
+class _Timeout(Exception):
+    pass
+
+
+def _transforms(rows, cols):
+    """Returns the (row, col) mappings of every symmetry of the board"""
+    last_row = rows - 1
+    last_col = cols - 1
+    transforms = [
+        lambda row, col: (row, col),
+        lambda row, col: (last_row - row, last_col - col),
+        lambda row, col: (row, last_col - col),
+        lambda row, col: (last_row - row, col),
+    ]
+    if rows == cols:
+        transforms += [
+            lambda row, col: (col, last_row - row),
+            lambda row, col: (last_col - col, row),
+            lambda row, col: (col, row),
+            lambda row, col: (last_col - col, last_row - row),
+        ]
+    return transforms
+
+
+def symmetries(rows, cols):
+    """Returns a (row tables, cell map) pair for every symmetry of the board.
+    Row tables map the bits of one row to their transformed cells, so
+    transforming a bitmask costs one lookup per row. The cell map sends
+    each cell to its transformed cell."""
+    shape = (rows, cols)
+    found = _SYMMETRIES.get(shape)
+    if found is None:
+        found = []
+        for transform in _transforms(rows, cols):
+            cell_map = []
+            for row in range(rows):
+                for col in range(cols):
+                    new_row, new_col = transform(row, col)
+                    cell_map.append(new_row * cols + new_col)
+
+            tables = []
+            for row in range(rows):
+                table = []
+                for row_bits in range(1 << cols):
+                    bits = 0
+                    for col in range(cols):
+                        if row_bits >> col & 1:
+                            bits |= 1 << cell_map[row * cols + col]
+                    table.append(bits)
+                tables.append(table)
+            found.append((tables, cell_map))
+        _SYMMETRIES[shape] = found
+    return found
+
+
+def canonical(rows, cols, mover, other):
+    """Returns (key, symmetry) for a position. The key is the same for
+    every rotation and reflection of the position. symmetry is the index
+    into symmetries() of the one that produced it."""
+    cells = rows * cols
+    row_mask = (1 << cols) - 1
+    best_key = None
+    best_symmetry = 0
+    for index, (tables, _) in enumerate(symmetries(rows, cols)):
+        new_mover = 0
+        new_other = 0
+        shift = 0
+        for table in tables:
+            new_mover |= table[mover >> shift & row_mask]
+            new_other |= table[other >> shift & row_mask]
+            shift += cols
+        key = new_mover << cells | new_other
+        if best_key is None or key < best_key:
+            best_key = key
+            best_symmetry = index
+    return best_key, best_symmetry
+
+
+def _table(shape):
+    table = _TABLES.get(shape)
+    if table is None or len(table) > MAX_TABLE_ENTRIES:
+        table = _TABLES[shape] = {}
+    return table
+
+
+class Solver(object):
+    """Alpha-beta search for one board shape. Bitmasks passed in are the
+    player to move's marks and the other player's marks."""
+
+    def __init__(self, rows, cols, winning_length, table=None):
+        self.rows = rows
+        self.cols = cols
+        self.cells = rows * cols
+        self.full = (1 << self.cells) - 1
+        self.masks = win_masks(rows, cols, winning_length)
+        self.cell_masks = [tuple(mask for mask in self.masks
+                                 if mask >> cell & 1)
+                           for cell in range(self.cells)]
+        self.table = _table((rows, cols, winning_length)) \
+            if table is None else table
+        self.nodes = 0
+        self.deadline = None
+        self.solved = False
+
+        # Cells on more lines are tried first
+        self.order = sorted(range(self.cells),
+                            key=lambda cell: -len(self.cell_masks[cell]))
+
+    def wins(self, bits, cell):
+        """Check if bits has a complete line through cell"""
+        for mask in self.cell_masks[cell]:
+            if bits & mask == mask:
+                return True
+        return False
+
+    def evaluate(self, mover, other):
+        """Heuristic score from the mover's side. Lines the opponent hasn't
+        blocked count for a player, more so the fuller they are."""
+        score = 0
+        for mask in self.masks:
+            if not mask & other:
+                score += LINE_WEIGHTS[popcount(mask & mover)]
+            elif not mask & mover:
+                score -= LINE_WEIGHTS[popcount(mask & other)]
+        return score
+
+    def best_move(self, mover, other, budget=DEFAULT_BUDGET_SECONDS):
+        """Returns (score, cell) for the position, deepening until it is
+        solved or budget seconds have passed. Afterwards solved says
+        whether the score is exact rather than a heuristic estimate."""
+        self.solved = False
+        empty = self.full & ~(mover | other)
+        moves = [cell for cell in self.order if empty >> cell & 1]
+        if not moves:
+            raise ValueError('The board is full')
+
+        # Take a win, otherwise block the opponent's, without searching
+        for cell in moves:
+            if self.wins(mover | 1 << cell, cell):
+                self.solved = True
+                return WIN_SCORE + len(moves) - 1, cell
+        for cell in moves:
+            if self.wins(other | 1 << cell, cell):
+                moves.remove(cell)
+                moves.insert(0, cell)
+                break
+
+        self.deadline = time.time() + budget
+        best = (0, moves[0])
+        for depth in range(1, len(moves) + 1):
+            try:
+                best = self._root(mover, other, moves, depth)
+            except _Timeout:
+                break
+
+            # Search the best move first at the next depth
+            moves.remove(best[1])
+            moves.insert(0, best[1])
+            if abs(best[0]) >= WIN_SCORE or depth == len(moves):
+                self.solved = True
+                break
+        return best
+
+    def _root(self, mover, other, moves, depth):
+        alpha = -WIN_SCORE * 2
+        best_cell = moves[0]
+        for cell in moves:
+            score = -self._search(other, mover | 1 << cell, depth - 1,
+                                  -WIN_SCORE * 2, -alpha)
+            if score > alpha:
+                alpha = score
+                best_cell = cell
+        return alpha, best_cell
+
+    def _search(self, mover, other, depth, alpha, beta):
+        self.nodes += 1
+        if not self.nodes % CLOCK_INTERVAL and time.time() > self.deadline:
+            raise _Timeout()
+
+        empty = self.full & ~(mover | other)
+        if not empty:
+            return 0
+        if depth == 0:
+            return self.evaluate(mover, other)
+
+        key, _ = canonical(self.rows, self.cols, mover, other)
+        entry = self.table.get(key)
+        if entry is not None:
+            entry_depth, flag, value = entry
+            if entry_depth >= depth or abs(value) >= WIN_SCORE:
+                if flag == EXACT:
+                    return value
+                elif flag == LOWER and value >= beta:
+                    return value
+                elif flag == UPPER and value <= alpha:
+                    return value
+
+        moves = [cell for cell in self.order if empty >> cell & 1]
+        for cell in moves:
+            if self.wins(mover | 1 << cell, cell):
+                value = WIN_SCORE + len(moves) - 1
+                self.table[key] = (depth, EXACT, value)
+                return value
+
+        original_alpha = alpha
+        best = -WIN_SCORE * 2
+        for cell in moves:
+            score = -self._search(other, mover | 1 << cell, depth - 1,
+                                  -beta, -alpha)
+            if score > best:
+                best = score
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        break
+
+        if best <= original_alpha:
+            flag = UPPER
+        elif best >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.table[key] = (depth, flag, best)
+        return best
+
+
+def load_book(path=BOOK_PATH):
+    """Returns the opening book as {(rows, cols, winning_length, key):
+    canonical move cell}"""
+    book = {}
+    if not os.path.exists(path):
+        return book
+    with open(path, 'rb') as book_file:
+        data = book_file.read()
+    for offset in range(0, len(data), _BOOK_RECORD.size):
+        rows, cols, winning_length, cell, mover, other = \
+            _BOOK_RECORD.unpack_from(data, offset)
+        book[(rows, cols, winning_length, mover << rows * cols | other)] = \
+            cell
+    return book
+
+
+def book_move(rows, cols, winning_length, mover, other):
+    """Returns the book's move for a position or None"""
+    global _book
+    if _book is None:
+        _book = load_book()
+
+    key, symmetry = canonical(rows, cols, mover, other)
+    cell = _book.get((rows, cols, winning_length, key))
+    if cell is None:
+        return None
+
+    # The book move is for the canonical position, map it back
+    cell_map = symmetries(rows, cols)[symmetry][1]
+    return cell_map.index(cell)
+
+
+def choose_move(bitboard, player, budget=DEFAULT_BUDGET_SECONDS):
+    """Returns the (row, col) the computer plays for player"""
+    mover = bitboard.bits(player)
+    other = bitboard.occupied() & ~mover
+    cell = book_move(bitboard.rows, bitboard.cols, bitboard.winning_length,
+                     mover, other)
+    if cell is None:
+        solver = Solver(bitboard.rows, bitboard.cols,
+                        bitboard.winning_length)
+        _, cell = solver.best_move(mover, other, budget)
+    return divmod(cell, bitboard.cols)
+
+
+def _book_positions(rows, cols, winning_length, max_marks):
+    """Yields (key, mover, other) for every canonical position reachable
+    with at most max_marks marks where the game is still going"""
+    solver = Solver(rows, cols, winning_length, table={})
+    seen = set()
+    frontier = [(0, 0)]
+    for marks in range(max_marks + 1):
+        next_frontier = []
+        for mover, other in frontier:
+            key, _ = canonical(rows, cols, mover, other)
+            if key in seen or mover | other == solver.full:
+                continue
+            seen.add(key)
+            yield key, mover, other
+
+            for cell in range(solver.cells):
+                if not (mover | other) >> cell & 1:
+                    moved = mover | 1 << cell
+                    if not solver.wins(moved, cell):
+                        next_frontier.append((other, moved))
+        frontier = next_frontier
+
+
+def build_book(path=BOOK_PATH):
+    """Searches every position in BOOK_DEPTHS and writes the book"""
+    records = []
+    for shape, max_marks in sorted(BOOK_DEPTHS.items()):
+        assert shape in NEW_GAME_SHAPES and shape[0] * shape[1] <= 16
+        rows, cols, winning_length = shape
+        table = {}
+        for key, mover, other in _book_positions(rows, cols, winning_length,
+                                                 max_marks):
+            solver = Solver(rows, cols, winning_length, table=table)
+            _, cell = solver.best_move(mover, other, BOOK_BUDGET_SECONDS)
+
+            # Store the move for the canonical orientation
+            symmetry = canonical(rows, cols, mover, other)[1]
+            cell = symmetries(rows, cols)[symmetry][1][cell]
+            cells = rows * cols
+            records.append(_BOOK_RECORD.pack(
+                rows, cols, winning_length, cell,
+                key >> cells, key & ((1 << cells) - 1)))
+
+    with open(path, 'wb') as book_file:
+        book_file.write(b''.join(records))
+    return len(records)
+
+
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] == ['--build-book']:
+        print('Wrote {} positions to {}'.format(build_book(), BOOK_PATH))
+    else:
+        sys.exit('Usage: python solver.py --build-book')
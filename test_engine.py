@@ -0,0 +1,195 @@
+"""test_engine.py - Tests for the game rules in engine.py. These don't need
+the App Engine runtime and can be run with pytest or directly with
+'python test_engine.py'."""
+
+import random
+import unittest
+
+from engine import Bitboard, DRAW, NEW_GAME_SHAPES, ONGOING, PLAYER_ONE, \
+    PLAYER_TWO, WON, dimensions
+
+RANDOM_GAMES = 3000
+
+
+def reference_has_won(board, player, winning_length):
+    """Brute-force win check. Tries every cell as the start of a line in
+    every direction."""
+    rows = len(board)
+    cols = len(board[0])
+    for row in range(rows):
+        for col in range(cols):
+            for row_step, col_step in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                for step in range(winning_length):
+                    check_row = row + row_step * step
+                    check_col = col + col_step * step
+                    if not (0 <= check_row < rows and 0 <= check_col < cols):
+                        break
+                    if board[check_row][check_col] != player:
+                        break
+                else:
+                    return True
+    return False
+
+
+def reachable_mark_sets(rows, cols):
+    """Yields every set of cells one player can hold during a game as a
+    bitmask. Player one moves first so can hold at most half the board,
+    rounded up."""
+    cells = rows * cols
+    most_marks = (cells + 1) // 2
+    for bits in range(1 << cells):
+        if bin(bits).count('1') <= most_marks:
+            yield bits
+
+
+class BitboardTest(unittest.TestCase):
+
+    def test_win(self):
+        board = [[1, 0, 0, 0],
+                 [0, 1, 0, 0],
+                 [0, 0, 1, 0],
+                 [0, 0, 0, 0],
+                 [0, 0, 0, 0]]
+        bitboard = Bitboard.from_board(board, 3)
+        self.assertTrue(bitboard.wins_through(PLAYER_ONE, 2, 2))
+        self.assertTrue(bitboard.has_won(PLAYER_ONE))
+        self.assertFalse(bitboard.is_full())
+
+    def test_draw(self):
+        board = [[1, 2, 1, 2],
+                 [2, 1, 2, 1],
+                 [1, 2, 1, 2],
+                 [2, 1, 2, 1],
+                 [1, 2, 1, 2]]
+        bitboard = Bitboard.from_board(board, 5)
+        self.assertFalse(bitboard.wins_through(PLAYER_ONE, 2, 2))
+        self.assertFalse(bitboard.has_won(PLAYER_ONE))
+        self.assertTrue(bitboard.is_full())
+
+    def test_anti_diagonal_away_from_edge(self):
+        board = [[0, 0, 0, 0, 0],
+                 [0, 0, 0, 2, 0],
+                 [0, 0, 2, 0, 0],
+                 [0, 2, 0, 0, 0],
+                 [0, 0, 0, 0, 0]]
+        bitboard = Bitboard.from_board(board, 3)
+        for row, col in ((1, 3), (2, 2), (3, 1)):
+            self.assertTrue(bitboard.wins_through(PLAYER_TWO, row, col))
+
+    def test_board_round_trip(self):
+        board = [[1, 0, 2],
+                 [0, 2, 0],
+                 [1, 0, 0]]
+        self.assertEqual(Bitboard.from_board(board, 3).to_board(), board)
+
+    def test_compact_formats_round_trip(self):
+        board = [[1, 0, 2, 0, 1],
+                 [2, 2, 1, 0, 0],
+                 [0, 0, 0, 0, 0],
+                 [1, 1, 1, 1, 2],
+                 [2, 0, 0, 0, 0]]
+        bitboard = Bitboard.from_board(board, 3)
+        self.assertEqual(bitboard.to_flat(), '1020122100000001111220000')
+        self.assertEqual(
+            Bitboard.from_flat(bitboard.to_flat(), 5, 5, 3).to_board(), board)
+        self.assertEqual(
+            Bitboard.from_packed(bitboard.to_packed(), 5, 5, 3).to_board(),
+            board)
+
+    def check_every_reachable_move(self, rows, cols, winning_length):
+        """A win only depends on the marks of the player who just moved, so
+        checking every mark-set a player can hold, with each of its cells as
+        the last move, covers every reachable position."""
+        reference = {}
+        for bits in reachable_mark_sets(rows, cols):
+            bitboard = Bitboard(rows, cols, winning_length, bits, 0)
+            reference[bits] = reference_has_won(bitboard.to_board(),
+                                                PLAYER_ONE, winning_length)
+            self.assertEqual(bitboard.has_won(PLAYER_ONE), reference[bits],
+                             bitboard.to_board())
+
+        for bits, expected in reference.items():
+            bitboard = Bitboard(rows, cols, winning_length, 0, bits)
+            for row in range(rows):
+                for col in range(cols):
+                    bit = 1 << (row * cols + col)
+
+                    # The game ends at the first win so the position before
+                    # the last move can't already be won
+                    if not bits & bit or reference[bits ^ bit]:
+                        continue
+
+                    self.assertEqual(
+                        bitboard.wins_through(PLAYER_TWO, row, col),
+                        expected, (bitboard.to_board(), row, col))
+
+    def test_exhaustive_3x3(self):
+        self.check_every_reachable_move(3, 3, 3)
+
+    def test_exhaustive_4x4_three_in_a_row(self):
+        self.check_every_reachable_move(4, 4, 3)
+
+    def test_exhaustive_4x4_four_in_a_row(self):
+        self.check_every_reachable_move(4, 4, 4)
+
+
+class RulesTest(unittest.TestCase):
+
+    def test_dimensions(self):
+        for freak_factor in range(100):
+            rows, cols, winning_length = dimensions(freak_factor)
+            if freak_factor % 3 == 0:
+                self.assertEqual((rows, cols), (5, 5))
+            elif freak_factor % 2 == 0:
+                self.assertEqual((rows, cols), (4, 4))
+            else:
+                self.assertEqual((rows, cols), (3, 3))
+            self.assertEqual(winning_length,
+                             rows if freak_factor >= 10 else 3)
+            self.assertIn((rows, cols, winning_length), NEW_GAME_SHAPES)
+
+    def test_illegal_moves(self):
+        bitboard = Bitboard(3, 3, 3)
+        bitboard.play(PLAYER_ONE, 1, 1)
+        for row, col in ((-1, 0), (0, 3), (3, 0), (1, 1)):
+            self.assertRaises(ValueError, bitboard.play, PLAYER_TWO, row, col)
+        self.assertEqual((bitboard.player_one, bitboard.player_two),
+                         (1 << 4, 0))
+
+    def test_random_games(self):
+        """Plays random games on every board new_game can make and checks
+        every move against the brute-force rules"""
+        rng = random.Random(19)
+        shapes = sorted(NEW_GAME_SHAPES)
+        for _ in range(RANDOM_GAMES):
+            rows, cols, winning_length = rng.choice(shapes)
+            bitboard = Bitboard(rows, cols, winning_length)
+            cells = [(row, col) for row in range(rows)
+                     for col in range(cols)]
+            rng.shuffle(cells)
+
+            player = PLAYER_ONE
+            for turn, (row, col) in enumerate(cells):
+                outcome = bitboard.play(player, row, col)
+
+                board = bitboard.to_board()
+                won = reference_has_won(board, player, winning_length)
+                full = turn == len(cells) - 1
+                self.assertEqual(outcome, WON if won else
+                                 DRAW if full else ONGOING, board)
+
+                # Player one always moves first so never has fewer marks
+                marks = sum(cell != 0 for line in board for cell in line)
+                self.assertEqual(marks, turn + 1)
+                self.assertIn(sum(cell == PLAYER_ONE for line in board
+                                  for cell in line) * 2 - marks, (0, 1))
+
+                if outcome != ONGOING:
+                    break
+                player = PLAYER_TWO if player == PLAYER_ONE else PLAYER_ONE
+
+            self.assertNotEqual(outcome, ONGOING)
+
+
+if __name__ == '__main__':
+    unittest.main()
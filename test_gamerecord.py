@@ -0,0 +1,126 @@
+"""test_gamerecord.py - Tests for the archived game records in gamerecord.py.
+Archiving deletes the original Games, so every record has to come back
+exactly as it went in."""
+
+import random
+import unittest
+
+import gamerecord
+import movelog
+from engine import NEW_GAME_SHAPES, ONGOING, WON, Bitboard, dimensions
+
+
+def play_game(rng, game_id, player_one, player_two, freak_factor):
+    """Plays random legal moves until the game ends, or is cancelled part
+    way. Returns the Record and the final Bitboard."""
+    rows, cols, winning_length = dimensions(freak_factor)
+    bitboard = Bitboard(rows, cols, winning_length)
+    log = movelog.append(None, movelog.NO_CELL, movelog.NO_CELL, 1,
+                         movelog.CREATED)
+    cells = [(row, col) for row in range(rows) for col in range(cols)]
+    rng.shuffle(cells)
+    cancel_after = rng.choice([None, rng.randint(0, len(cells) - 1)])
+
+    whos_turn = 1
+    winner = None
+    for turn, (row, col) in enumerate(cells):
+        if turn == cancel_after:
+            log = movelog.append(log, movelog.NO_CELL, movelog.NO_CELL,
+                                 whos_turn, movelog.CANCELLED)
+            break
+        outcome = bitboard.play(whos_turn, row, col)
+        if outcome == ONGOING:
+            log = movelog.append(log, row, col, whos_turn,
+                                 movelog.MOVE_ACCEPTED)
+            whos_turn = 2 if whos_turn == 1 else 1
+            continue
+        if outcome == WON:
+            winner = player_one if whos_turn == 1 else player_two
+            log = movelog.append(log, row, col, whos_turn, movelog.WON)
+        else:
+            log = movelog.append(log, row, col, whos_turn, movelog.DRAW)
+        break
+
+    record = gamerecord.Record(
+        game_id=game_id, player_one=player_one, player_two=player_two,
+        winner=winner, freak_factor=freak_factor, rows=rows, cols=cols,
+        winning_length=winning_length, whos_turn=whos_turn,
+        version=len(log) // movelog.ENTRY_SIZE, move_log=log)
+    return record, bitboard
+
+
+class GameRecordTest(unittest.TestCase):
+
+    def check_part(self, games):
+        """Packs the games into one part and checks each comes back"""
+        players = []
+        player_index = {}
+        data = b''
+        offsets = []
+        for record, _ in games:
+            offsets.append(len(data))
+            data += gamerecord.pack(record, players, player_index)
+
+        self.assertEqual(list(gamerecord.records(data)),
+                         [(offset, record.game_id)
+                          for offset, (record, _) in zip(offsets, games)])
+        for offset, (record, bitboard) in zip(offsets, games):
+            unpacked = gamerecord.unpack(data, offset, players)
+            self.assertEqual(unpacked, record)
+            board = gamerecord.bitboard(unpacked)
+            self.assertEqual((board.player_one, board.player_two),
+                             (bitboard.player_one, bitboard.player_two))
+        return players
+
+    def test_round_trip(self):
+        rng = random.Random(25)
+        games = []
+        for game_id in range(1, 301):
+            freak_factor = rng.randint(-50, 50)
+            self.assertIn(dimensions(freak_factor), NEW_GAME_SHAPES)
+            games.append(play_game(rng, game_id * 7919, 'one', 'two',
+                                   freak_factor))
+        self.check_part(games)
+
+    def test_tournament_shares_players(self):
+        rng = random.Random(23)
+        names = ['player{}'.format(index) for index in range(8)]
+        games = [play_game(rng, 5000 + index, first, second, 12)
+                 for index, (first, second) in enumerate(
+                     (first, second) for position, first in enumerate(names)
+                     for second in names[position + 1:])]
+        self.assertEqual(len(games), 28)
+
+        players = self.check_part(games)
+        self.assertEqual(sorted(players), names)
+
+    def test_limits(self):
+        record, bitboard = play_game(random.Random(1), 2 ** 62, 'one', 'two',
+                                     2 ** 31 - 1)
+        self.check_part([(record, bitboard)])
+
+        # Every header field at the top of its range
+        longest = record._replace(
+            move_log=record.move_log * (65535 // len(record.move_log)),
+            version=2 ** 32 - 1)
+        longest = longest._replace(
+            move_log=longest.move_log[:65535 // movelog.ENTRY_SIZE *
+                                      movelog.ENTRY_SIZE])
+        self.assertEqual(gamerecord.unpack(
+            gamerecord.pack(longest, [], {}), 0, ['one', 'two']), longest)
+
+    def test_out_of_range(self):
+        record, _ = play_game(random.Random(2), 1, 'one', 'two', 3)
+        players = ['zero']
+        player_index = {'zero': 0}
+        for bad in (record._replace(freak_factor=2 ** 31),
+                    record._replace(freak_factor=-2 ** 31 - 1),
+                    record._replace(move_log=b'\0' * 65536)):
+            self.assertRaises(ValueError, gamerecord.pack, bad, players,
+                              player_index)
+            self.assertEqual(players, ['zero'])
+            self.assertEqual(player_index, {'zero': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+"""test_movelog.py - Tests for the packed move log in movelog.py"""
+
+import unittest
+
+import movelog
+
+
+class MoveLogTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        log = movelog.append(None, movelog.NO_CELL, movelog.NO_CELL, 1,
+                             movelog.CREATED)
+        log = movelog.append(log, 0, 2, 1, movelog.MOVE_ACCEPTED)
+        log = movelog.append(log, 4, 4, 2, movelog.WON)
+
+        self.assertEqual(len(log), 3 * movelog.ENTRY_SIZE)
+        self.assertEqual(movelog.entries(log), [
+            (movelog.NO_CELL, movelog.NO_CELL, 1, movelog.CREATED),
+            (0, 2, 1, movelog.MOVE_ACCEPTED),
+            (4, 4, 2, movelog.WON)])
+        self.assertEqual(movelog.last(log), (4, 4, 2, movelog.WON))
+
+    def test_empty(self):
+        self.assertEqual(movelog.entries(None), [])
+        self.assertEqual(movelog.entries(b''), [])
+
+    def test_message_ids_from_text(self):
+        for message_id in movelog.MESSAGES:
+            text = movelog.message(message_id, 'someone')
+            self.assertEqual(movelog.message_id(text), message_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
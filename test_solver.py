@@ -0,0 +1,105 @@
+"""test_solver.py - Tests for the computer opponent in solver.py. Like
+test_engine.py these run without the App Engine runtime."""
+
+import random
+import unittest
+
+from engine import Bitboard, NEW_GAME_SHAPES, ONGOING, PLAYER_ONE, \
+    PLAYER_TWO, WON
+from solver import WIN_SCORE, Solver, book_move, canonical, choose_move, \
+    symmetries
+
+
+def transform(bits, cell_map):
+    moved = 0
+    for cell, new_cell in enumerate(cell_map):
+        if bits >> cell & 1:
+            moved |= 1 << new_cell
+    return moved
+
+
+class SolverTest(unittest.TestCase):
+
+    def test_canonical_is_the_same_for_every_symmetry(self):
+        rng = random.Random(21)
+        for rows, cols, _ in NEW_GAME_SHAPES:
+            cells = list(range(rows * cols))
+            for _ in range(50):
+                rng.shuffle(cells)
+                marks = rng.randint(0, len(cells))
+                mover = sum(1 << cell for cell in cells[:marks // 2])
+                other = sum(1 << cell for cell in cells[marks // 2:marks])
+                key, _ = canonical(rows, cols, mover, other)
+                for _, cell_map in symmetries(rows, cols):
+                    self.assertEqual(
+                        canonical(rows, cols, transform(mover, cell_map),
+                                  transform(other, cell_map))[0], key)
+
+    def test_takes_a_win(self):
+        board = Bitboard.from_board([[1, 1, 0, 0],
+                                     [2, 2, 0, 0],
+                                     [0, 0, 0, 0],
+                                     [0, 0, 0, 0]], 3)
+        solver = Solver(4, 4, 3, table={})
+        score, cell = solver.best_move(board.player_one, board.player_two)
+        self.assertEqual(cell, 2)
+        self.assertTrue(score >= WIN_SCORE)
+
+    def test_blocks_a_win(self):
+        board = Bitboard.from_board([[1, 1, 0, 2, 0],
+                                     [0, 0, 0, 0, 0],
+                                     [0, 0, 0, 0, 0],
+                                     [0, 0, 0, 0, 0],
+                                     [0, 0, 0, 0, 2]], 3)
+        self.assertEqual(choose_move(board, PLAYER_TWO, budget=0.2), (0, 2))
+
+    def test_book_moves_are_legal(self):
+        rng = random.Random(4)
+        for shape in ((3, 3, 3), (4, 4, 3), (4, 4, 4)):
+            for _ in range(50):
+                bitboard = Bitboard(*shape)
+                cells = [(row, col) for row in range(shape[0])
+                         for col in range(shape[1])]
+                rng.shuffle(cells)
+                marks = rng.randint(0, 2)
+                for turn, (row, col) in enumerate(cells[:marks]):
+                    bitboard.mark(PLAYER_ONE if turn % 2 == 0
+                                  else PLAYER_TWO, row, col)
+
+                player = PLAYER_ONE if marks % 2 == 0 else PLAYER_TWO
+                mover = bitboard.bits(player)
+                cell = book_move(shape[0], shape[1], shape[2], mover,
+                                 bitboard.occupied() & ~mover)
+                self.assertIsNotNone(cell)
+                self.assertTrue(bitboard.is_free(*divmod(cell, shape[1])))
+
+    def check_never_loses(self, bitboard, computer, to_move):
+        """Tries every reply to the computer on a 3x3 board"""
+        if to_move == computer:
+            row, col = choose_move(bitboard, computer)
+            outcome = bitboard.play(computer, row, col)
+            if outcome == ONGOING:
+                self.check_never_loses(bitboard, computer,
+                                       3 - computer)
+            bitboard.player_one &= ~(1 << (row * 3 + col))
+            bitboard.player_two &= ~(1 << (row * 3 + col))
+            return
+
+        for row in range(3):
+            for col in range(3):
+                if not bitboard.is_free(row, col):
+                    continue
+                outcome = bitboard.play(to_move, row, col)
+                self.assertNotEqual(outcome, WON, bitboard.to_board())
+                if outcome == ONGOING:
+                    self.check_never_loses(bitboard, computer, computer)
+                bitboard.player_one &= ~(1 << (row * 3 + col))
+                bitboard.player_two &= ~(1 << (row * 3 + col))
+
+    def test_never_loses_3x3(self):
+        self.check_never_loses(Bitboard(3, 3, 3), PLAYER_ONE, PLAYER_ONE)
+        self.check_never_loses(Bitboard(3, 3, 3), PLAYER_TWO, PLAYER_ONE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,12 @@
 """utils.py - File for collecting general utility functions."""
 
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
+DEFAULT_PAGE_SIZE = 25
+MAX_PAGE_SIZE = 100
+
 
 def get_by_urlsafe(urlsafe, model):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
@@ -17,8 +21,15 @@ def get_by_urlsafe(urlsafe, model):
         exists.
     Raises:
         ValueError:"""
+    return check_kind(key_from_urlsafe(urlsafe).get(), model)
+
+
+def key_from_urlsafe(urlsafe):
+    """Returns the ndb.Key for a urlsafe key string
+    Raises:
+        endpoints.BadRequestException: If the key string is malformed"""
     try:
-        key = ndb.Key(urlsafe=urlsafe)
+        return ndb.Key(urlsafe=urlsafe)
     except TypeError:
         raise endpoints.BadRequestException('Invalid Key')
     except Exception, e:
@@ -27,9 +38,43 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
-    entity = key.get()
+
+def check_kind(entity, model):
+    """Returns the entity, or None if there is no entity
+    Raises:
+        ValueError: If the entity is not an instance of model"""
     if not entity:
         return None
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
     return entity
+
+
+def page_size(limit):
+    """Returns the number of results to put in a page for a requested
+    limit, falling back to DEFAULT_PAGE_SIZE and capped at MAX_PAGE_SIZE"""
+    if not limit or limit < 1:
+        return DEFAULT_PAGE_SIZE
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def fetch_page(query, limit, page_token):
+    """Fetches one page of a query.
+    Args:
+        query: The ndb.Query to run
+        limit: The requested page size
+        page_token: A urlsafe cursor from a previous page or None
+    Returns:
+        A list of entities and the page token for the next page, which is
+        None when there are no more results.
+    Raises:
+        endpoints.BadRequestException: If the page token is malformed"""
+    try:
+        cursor = Cursor(urlsafe=page_token) if page_token else None
+    except Exception:
+        raise endpoints.BadRequestException('Invalid page token')
+
+    results, next_cursor, more = query.fetch_page(page_size(limit),
+                                                  start_cursor=cursor)
+    next_token = next_cursor.urlsafe() if more and next_cursor else None
+    return results, next_token